@@ -0,0 +1,116 @@
+"""
+Compare the latency and CPU time of pulls with each git backend.
+
+Creates a repository, clones it once per backend, and times repeated pulls
+that find the clone up to date, and pulls that merge new commits into a clone
+with local changes. CPU time includes the git processes started. Backends that
+can't be used (dulwich, if it isn't installed) are left out. Results are
+reported as JSON.
+
+    python benchmarks/bench_backends.py --files 500 --repeat 20
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+from nbgitpuller import backends
+from nbgitpuller.pull import GitPuller, git_env
+
+
+def git(*args, cwd):
+    return subprocess.check_output(('git',) + args, cwd=cwd, env=git_env()).decode()
+
+
+def commit_all(work, message):
+    git('add', '-A', cwd=work)
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+        'commit', '--quiet', '-m', message, cwd=work)
+    git('push', '--quiet', 'origin', 'HEAD:main', cwd=work)
+
+
+def make_remote(tmp, files):
+    """
+    Create a bare repository in tmp holding the given number of files, and a
+    working copy to push more commits to it from
+    """
+    remote = os.path.join(tmp, 'remote.git')
+    work = os.path.join(tmp, 'work')
+    git('init', '--quiet', '--bare', remote, cwd=tmp)
+    os.makedirs(os.path.join(work, 'data'))
+    git('init', '--quiet', cwd=work)
+    git('remote', 'add', 'origin', remote, cwd=work)
+    for i in range(files):
+        with open(os.path.join(work, 'data', 'file{}.txt'.format(i)), 'w') as f:
+            f.write('file {}\n'.format(i))
+    commit_all(work, 'files')
+    return remote, work
+
+
+def cpu_seconds():
+    own = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own + children.ru_utime + children.ru_stime
+
+
+def measure(gp, prepare, repeat):
+    """
+    Return the median wall and CPU time of a pull, calling prepare before
+    each one
+    """
+    walls = []
+    cpus = []
+    for _ in range(repeat):
+        prepare()
+        start_wall = time.perf_counter()
+        start_cpu = cpu_seconds()
+        for _ in gp.pull():
+            pass
+        walls.append(time.perf_counter() - start_wall)
+        cpus.append(cpu_seconds() - start_cpu)
+    walls.sort()
+    cpus.sort()
+    return {
+        'wall_ms': round(walls[len(walls) // 2] * 1000, 2),
+        'cpu_ms': round(cpus[len(cpus) // 2] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=500, help='Number of files in the repository')
+    parser.add_argument('--repeat', type=int, default=20, help='Pulls per scenario, the median is kept')
+    args = parser.parse_args()
+
+    names = ['cli'] + (['dulwich'] if backends.Repo is not None else [])
+    results = {'files': args.files, 'backends': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, work = make_remote(tmp, args.files)
+        for name in names:
+            repo_dir = os.path.join(tmp, 'clone-' + name)
+            gp = GitPuller('file://' + remote, repo_dir, branch='main', git_backend=name, depth=0)
+            for _ in gp.pull():
+                pass
+            counter = iter(range(args.repeat))
+
+            def push_and_edit():
+                i = next(counter)
+                with open(os.path.join(work, 'upstream.txt'), 'w') as f:
+                    f.write('{} {}\n'.format(name, i))
+                commit_all(work, 'upstream change')
+                with open(os.path.join(repo_dir, 'data', 'file0.txt'), 'w') as f:
+                    f.write('local change {}\n'.format(i))
+
+            results['backends'][name] = {
+                'up_to_date': measure(gp, lambda: None, args.repeat),
+                'merge_local_changes': measure(gp, push_and_edit, args.repeat),
+            }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Compare the throughput of execute_cmd against the original 1-byte reader.
+
+Generates a multi-megabyte file of synthetic git output (progress lines that
+overwrite themselves with `\\r`, interleaved with regular `\\n` lines), then
+reads it through both implementations with `cat` and reports the results as
+JSON.
+
+    python benchmarks/bench_execute_cmd.py --size-mb 16
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+from functools import partial
+
+from nbgitpuller.pull import execute_cmd
+
+
+def legacy_execute_cmd(cmd, **kwargs):
+    """
+    The original implementation of execute_cmd, reading one byte at a time
+    """
+    yield '$ {}\n'.format(' '.join(cmd))
+    kwargs['stdout'] = subprocess.PIPE
+    kwargs['stderr'] = subprocess.STDOUT
+    kwargs['env'] = dict(os.environ, LANG='C')
+
+    proc = subprocess.Popen(cmd, **kwargs)
+
+    buf = []
+
+    def flush():
+        line = b''.join(buf).decode('utf8', 'replace')
+        buf[:] = []
+        return line
+
+    c_last = ''
+    try:
+        for c in iter(partial(proc.stdout.read, 1), b''):
+            if c_last == b'\r' and buf and c != b'\n':
+                yield flush()
+            buf.append(c)
+            if c == b'\n':
+                yield flush()
+            c_last = c
+    finally:
+        ret = proc.wait()
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+
+
+def write_synthetic_output(path, size):
+    """
+    Write roughly size bytes of output resembling `git clone --progress`
+    """
+    with open(path, 'wb') as f:
+        written = 0
+        i = 0
+        while written < size:
+            if i % 100 == 99:
+                line = 'remote: Enumerating objects: {}, done.\n'.format(i)
+            else:
+                line = 'Receiving objects: {:3d}% ({}/{}), 3.14 MiB | 2.72 MiB/s\r'.format(
+                    i % 100, i, size
+                )
+            data = line.encode()
+            f.write(data)
+            written += len(data)
+            i += 1
+        f.write(b'done.\n')
+
+
+def measure(impl, path, repeat):
+    best = None
+    lines = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines = list(impl(['cat', path]))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=8, help='Size of the synthetic output')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, the best is kept')
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'output.txt')
+        write_synthetic_output(path, size)
+
+        results = {'size_bytes': os.path.getsize(path)}
+        outputs = {}
+        for name, impl in [('legacy', legacy_execute_cmd), ('chunked', execute_cmd)]:
+            elapsed, outputs[name] = measure(impl, path, args.repeat)
+            results[name] = {
+                'seconds': round(elapsed, 4),
+                'mb_per_second': round(results['size_bytes'] / elapsed / 1024 / 1024, 2),
+                'lines': len(outputs[name]),
+            }
+
+    results['identical_output'] = outputs['legacy'] == outputs['chunked']
+    results['speedup'] = round(results['legacy']['seconds'] / results['chunked']['seconds'], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
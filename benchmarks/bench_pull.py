@@ -0,0 +1,208 @@
+"""
+Benchmark GitPuller.pull() in common clone and update scenarios.
+
+Generates a synthetic repository with the Remote, Pusher and Puller helpers
+from tests/repohelpers.py, sized by number of files, length of history and
+size of each file, and times pulls in these scenarios:
+
+- clone: the first pull of a link, cloning the repository
+- noop: pulling a clone that is already up to date
+- local-edits: pulling new commits into a clone the user edited
+- modify-delete: pulling the deletion of a file the user edited
+- mass-delete: pulling after the user deleted every file
+
+The same seed always generates the same repository. Results, including the
+time of each phase of the pulls, are printed as JSON. Pass the results of an
+earlier run with --compare to fail if a scenario got slower.
+
+    python benchmarks/bench_pull.py --files 1000 --history 50 --output results.json
+    python benchmarks/bench_pull.py --files 1000 --history 50 --compare results.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from repohelpers import Remote, Pusher, Puller  # noqa: E402
+from nbgitpuller.pull import Timings, git_version  # noqa: E402
+
+SCENARIOS = ['clone', 'noop', 'local-edits', 'modify-delete', 'mass-delete']
+
+# Files per directory of the synthetic repository
+FILES_PER_DIR = 100
+
+
+def file_path(i):
+    return 'data/d{}/file{}.txt'.format(i // FILES_PER_DIR, i)
+
+
+def generate(pusher, args):
+    """
+    Fill pusher's repository with args.files files of args.blob_size bytes
+    and args.history commits, and push it
+    """
+    rng = random.Random(args.seed)
+
+    def content():
+        return ''.join(rng.choice('abcdefghij\n') for _ in range(args.blob_size))
+
+    for i in range(args.files):
+        path = os.path.join(pusher.path, file_path(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pusher.write_file(file_path(i), content())
+    pusher.git('add', '-A')
+    pusher.git('commit', '-m', 'Initial files')
+    for n in range(1, args.history):
+        pusher.write_file(file_path(rng.randrange(args.files)), content())
+        pusher.git('commit', '-am', 'Change {}'.format(n))
+    pusher.git('push', 'origin', 'master')
+
+
+def consume(gp):
+    """
+    Pull with gp, returning the time it took and the times of its phases
+    """
+    gp.timings = Timings()
+    start = time.perf_counter()
+    for _ in gp.pull():
+        pass
+    return time.perf_counter() - start, gp.timings
+
+
+@contextlib.contextmanager
+def cloned(remote, args):
+    """
+    Clone remote with the Puller helper, without printing its output
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        with Puller(remote, **puller_options(args)) as puller:
+            yield puller
+
+
+def puller_options(args):
+    return {'depth': args.depth, 'merge_engine': args.merge_engine, 'git_backend': args.git_backend}
+
+
+def run_scenario(name, remote, pusher, args):
+    """
+    Run scenario name args.repeat times, returning the time of each run and
+    its Timings
+    """
+    runs = []
+    if name == 'clone':
+        for _ in range(args.repeat):
+            puller = Puller(remote, **puller_options(args))
+            try:
+                runs.append(consume(puller.gp))
+            finally:
+                shutil.rmtree(puller.path)
+        return runs
+
+    with cloned(remote, args) as puller:
+        for n in range(args.repeat):
+            if name == 'local-edits':
+                pusher.write_file(file_path(n % args.files), 'upstream {}\n'.format(n))
+                pusher.git('commit', '-am', 'Upstream change {}'.format(n))
+                pusher.git('push', 'origin', 'master')
+                puller.write_file(file_path((n + 1) % args.files), 'local {}\n'.format(n))
+            elif name == 'modify-delete':
+                path = file_path(n % args.files)
+                pusher.git('rm', '--quiet', path)
+                pusher.git('commit', '-m', 'Delete {}'.format(path))
+                pusher.git('push', 'origin', 'master')
+                puller.write_file(path, 'local {}\n'.format(n))
+            elif name == 'mass-delete':
+                shutil.rmtree(os.path.join(puller.path, 'data'))
+            runs.append(consume(puller.gp))
+    return runs
+
+
+def summarize(runs):
+    """
+    Return the median, minimum and maximum time of runs, and the median time
+    of each phase
+    """
+    seconds = [elapsed for elapsed, _ in runs]
+    phases = {}
+    for _, timings in runs:
+        for phase, totals in timings.phases.items():
+            phases.setdefault(phase, []).append(totals['wall'])
+    return {
+        'runs': len(runs),
+        'median_s': round(statistics.median(seconds), 4),
+        'min_s': round(min(seconds), 4),
+        'max_s': round(max(seconds), 4),
+        'phases_median_s': {
+            phase: round(statistics.median(walls), 4) for phase, walls in phases.items()
+        },
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a description of each scenario that is slower than in baseline by
+    more than tolerance
+    """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before and result['median_s'] > before['median_s'] * tolerance:
+            regressions.append('{}: {:.4f}s, was {:.4f}s'.format(name, result['median_s'], before['median_s']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=200, help='Number of files in the repository')
+    parser.add_argument('--history', type=int, default=10, help='Number of commits in the repository')
+    parser.add_argument('--blob-size', type=int, default=1024, help='Size of each file in bytes')
+    parser.add_argument('--depth', type=int, default=1, help='Depth of the clones, 0 for full clones')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated content')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Scenario to run, all by default')
+    parser.add_argument('--merge-engine', default='merge', help='GitPuller.merge_engine to use')
+    parser.add_argument('--git-backend', default='cli', help='GitPuller.git_backend to use')
+    parser.add_argument('--output', help='Also write the results to this file')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    parser.add_argument(
+        '--tolerance', type=float, default=1.25,
+        help='Fail if a scenario takes this many times longer than in --compare'
+    )
+    args = parser.parse_args()
+
+    results = {
+        'config': {
+            key: getattr(args, key)
+            for key in ['files', 'history', 'blob_size', 'depth', 'repeat', 'seed', 'merge_engine', 'git_backend']
+        },
+        'git_version': '.'.join(str(part) for part in git_version()),
+        'scenarios': {},
+    }
+    with Remote() as remote, Pusher(remote) as pusher:
+        generate(pusher, args)
+        for name in args.scenario or SCENARIOS:
+            results['scenarios'][name] = summarize(run_scenario(name, remote, pusher, args))
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Slower than before: {}'.format(regression), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
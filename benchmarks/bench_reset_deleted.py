@@ -0,0 +1,96 @@
+"""
+Compare restoring deleted files one at a time against the batched restore.
+
+Creates a repository with many files, clones it with GitPuller, deletes every
+file, and restores them with both the original one-checkout-per-file loop and
+GitPuller.reset_deleted_files, reporting the results as JSON.
+
+    python benchmarks/bench_reset_deleted.py --files 2000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from nbgitpuller.pull import GitPuller, git_env, run_steps
+
+
+def git(*args, cwd):
+    return subprocess.check_output(('git',) + args, cwd=cwd, env=git_env()).decode()
+
+
+def make_remote(path, files):
+    """
+    Create a bare repository at path holding the given number of files
+    """
+    work = path + '-work'
+    os.makedirs(os.path.join(work, 'data'))
+    git('init', '--quiet', '--bare', path, cwd=os.path.dirname(path))
+    git('init', '--quiet', work, cwd=os.path.dirname(path))
+    for i in range(files):
+        with open(os.path.join(work, 'data', 'file{}.txt'.format(i)), 'w') as f:
+            f.write('file {}\n'.format(i))
+    git('add', '.', cwd=work)
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+        'commit', '--quiet', '-m', 'files', cwd=work)
+    git('push', '--quiet', path, 'HEAD:refs/heads/main', cwd=work)
+
+
+def delete_files(repo_dir):
+    shutil.rmtree(os.path.join(repo_dir, 'data'))
+
+
+def legacy_reset_deleted_files(repo_dir, branch):
+    """
+    The original restore, running git checkout once per deleted file
+    """
+    deleted = git('ls-files', '--deleted', '-z', cwd=repo_dir).split('\0')
+    for filename in deleted:
+        if filename:
+            git('checkout', 'origin/{}'.format(branch), '--', filename, cwd=repo_dir)
+
+
+def batched_reset_deleted_files(gp):
+    for _ in run_steps(gp.reset_deleted_files()):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=2000, help='Number of files to delete and restore')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = os.path.join(tmp, 'remote.git')
+        make_remote(remote, args.files)
+
+        repo_dir = os.path.join(tmp, 'clone')
+        gp = GitPuller('file://' + remote, repo_dir, branch='main')
+        for _ in gp.pull():
+            pass
+
+        results = {'files': args.files}
+        for name, restore in [
+            ('legacy', lambda: legacy_reset_deleted_files(repo_dir, 'main')),
+            ('batched', lambda: batched_reset_deleted_files(gp)),
+        ]:
+            delete_files(repo_dir)
+            start = time.perf_counter()
+            restore()
+            elapsed = time.perf_counter() - start
+            missing = git('ls-files', '--deleted', cwd=repo_dir).splitlines()
+            results[name] = {
+                'seconds': round(elapsed, 4),
+                'files_per_second': round(args.files / elapsed, 1),
+                'still_deleted': len(missing),
+            }
+
+    results['speedup'] = round(results['legacy']['seconds'] / results['batched']['seconds'], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Load test the sync API of a Jupyter server with nbgitpuller.
+
+Starts a jupyter-server with the extension enabled in a temporary directory,
+and points many clients at its git-pull/api endpoint at once, each syncing
+one of a few local repositories into its own directory (or all into the same
+one with --same-target). Reports percentiles of the time to the first event
+and to the end of each sync, the server's peak memory use, and how late a
+request to the server was answered while the syncs ran, as a measure of how
+blocked its event loop was. Results are reported as JSON.
+
+--git-delay makes every git command that talks to a remote take that many
+seconds longer, standing in for a slow git host. Run with --waves 2 to also
+measure syncs of clones that already exist.
+
+    python benchmarks/loadtest_sync.py --clients 50 --waves 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from repohelpers import Remote, Pusher  # noqa: E402
+
+TOKEN = 'loadtest'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    """
+    Return the 50th, 95th and 99th percentiles and the maximum of values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1)]
+
+    return {
+        'p50': round(rank(50), 4),
+        'p95': round(rank(95), 4),
+        'p99': round(rank(99), 4),
+        'max': round(values[-1], 4),
+    }
+
+
+def write_slow_git(path, delay):
+    """
+    Write a `git` to path that takes delay seconds longer for the commands
+    that talk to a remote
+    """
+    os.makedirs(path)
+    script = os.path.join(path, 'git')
+    with open(script, 'w') as f:
+        f.write(
+            '#!/bin/sh\n'
+            'case "$*" in *ls-remote*|*fetch*|*clone*) sleep {};; esac\n'
+            'exec {} "$@"\n'.format(delay, shutil.which('git'))
+        )
+    os.chmod(script, 0o755)
+
+
+def start_server(tmp, port, env):
+    """
+    Start a jupyter-server with nbgitpuller enabled, and wait for it to answer
+    """
+    subprocess.check_call(
+        ['jupyter', 'server', 'extension', 'enable', 'nbgitpuller'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    root = os.path.join(tmp, 'root')
+    os.makedirs(root)
+    proc = subprocess.Popen(
+        ['jupyter-server', '--no-browser', '--ServerApp.token=' + TOKEN, '--port={}'.format(port)],
+        cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('The server did not start')
+
+
+def rss_mb(pid):
+    """
+    Return the resident memory of process pid in MiB, or None where /proc
+    isn't available
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+async def sync(client, port, params):
+    """
+    Run one sync, returning the time to its first event and to its last,
+    and whether it finished without an error
+    """
+    start = time.perf_counter()
+    first = None
+    received = []
+
+    def on_chunk(chunk):
+        nonlocal first
+        if first is None:
+            first = time.perf_counter() - start
+        received.append(chunk)
+
+    url = 'http://localhost:{}/git-pull/api?{}'.format(port, urlencode(dict(params, token=TOKEN)))
+    await client.fetch(HTTPRequest(url, streaming_callback=on_chunk, request_timeout=3600))
+    body = b''.join(received).decode('utf8', 'replace')
+    return first, time.perf_counter() - start, '"phase": "finished"' in body
+
+
+async def watch(port, pid, stop, samples):
+    """
+    Until stop is set, request a page from the server every 100ms, recording
+    how long it took to answer and the server's memory use
+    """
+    client = AsyncHTTPClient(force_instance=True)
+    url = 'http://localhost:{}/api/status?token={}'.format(port, TOKEN)
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.fetch(url, raise_error=False, request_timeout=3600)
+        samples['lag'].append(time.perf_counter() - start)
+        memory = rss_mb(pid)
+        if memory is not None:
+            samples['rss'].append(memory)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+    client.close()
+
+
+async def run_wave(port, pid, remotes, args):
+    client = AsyncHTTPClient(force_instance=True, max_clients=args.clients)
+    samples = {'lag': [], 'rss': []}
+    stop = asyncio.Event()
+    watcher = asyncio.ensure_future(watch(port, pid, stop, samples))
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        sync(client, port, {
+            'repo': 'file://' + os.path.abspath(remotes[i % len(remotes)].path),
+            'branch': 'master',
+            'targetpath': 'target' if args.same_target else 'target{}'.format(i),
+        })
+        for i in range(args.clients)
+    ])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await watcher
+    client.close()
+    return {
+        'seconds': round(elapsed, 3),
+        'errors': sum(1 for _, _, finished in results if not finished),
+        'first_event_s': percentiles([first for first, _, _ in results if first is not None]),
+        'finished_s': percentiles([total for _, total, _ in results]),
+        'event_loop_lag_s': percentiles(samples['lag']),
+        'peak_rss_mb': round(max(samples['rss']), 1) if samples['rss'] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=20, help='Number of simultaneous syncs')
+    parser.add_argument('--remotes', type=int, default=1, help='Number of repositories the clients sync')
+    parser.add_argument('--files', type=int, default=100, help='Number of files in each repository')
+    parser.add_argument('--waves', type=int, default=1, help='Times to run all the syncs, one after the other')
+    parser.add_argument('--same-target', action='store_true', help='Sync every client into the same directory')
+    parser.add_argument('--git-delay', type=float, default=0, help='Seconds to add to git commands using a remote')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            JUPYTER_CONFIG_DIR=os.path.join(tmp, 'config'),
+            JUPYTER_RUNTIME_DIR=os.path.join(tmp, 'runtime'),
+        )
+        if args.git_delay:
+            slow_git_dir = os.path.join(tmp, 'slow-git')
+            write_slow_git(slow_git_dir, args.git_delay)
+            env['PATH'] = slow_git_dir + os.pathsep + env['PATH']
+
+        remotes = []
+        try:
+            for _ in range(args.remotes):
+                remote = Remote().__enter__()
+                remotes.append(remote)
+                with Pusher(remote) as pusher:
+                    for i in range(args.files):
+                        pusher.write_file('file{}.txt'.format(i), 'content {}\n'.format(i))
+                    pusher.git('add', '-A')
+                    pusher.git('commit', '-m', 'Files')
+                    pusher.git('push', 'origin', 'master')
+
+            port = free_port()
+            server = start_server(tmp, port, env)
+            try:
+                waves = [
+                    asyncio.run(run_wave(port, server.pid, remotes, args))
+                    for _ in range(args.waves)
+                ]
+            finally:
+                server.terminate()
+                server.wait()
+        finally:
+            for remote in remotes:
+                remote.__exit__()
+
+    config = {key: getattr(args, key) for key in ['clients', 'remotes', 'files', 'same_target', 'git_delay']}
+    print(json.dumps({'config': config, 'waves': waves}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
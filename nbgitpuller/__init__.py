@@ -64,6 +64,12 @@ def _load_jupyter_server_extension(app):
     web_app.settings['nbapp'] = app
     web_app.add_handlers('.*', handlers)
 
+    # Files that weren't downloaded when cloning (see GitPuller.lazy_blob_limit)
+    # are downloaded when they are first opened
+    from .lazy import install_contents_hook
+
+    install_contents_hook(app)
+
 
 # For compatibility with both notebook and jupyter_server, we define
 # _jupyter_server_extension_paths alongside _jupyter_server_extension_points.
@@ -0,0 +1,304 @@
+"""
+Backends answering the questions GitPuller asks about the state of a clone.
+
+Most of what happens during a pull is asking questions: is the clone up to
+date, has the user changed anything, which files did they delete, and what
+changed upstream. GitCLIBackend, the default, runs a git command for each of
+them. DulwichBackend answers them in the Python process with dulwich, when it
+is installed, saving a process each time. Anything that changes the clone or
+talks to the remote always uses the git command line.
+
+GitPuller.git_backend selects the backend.
+"""
+import logging
+import os
+import re
+import subprocess
+from functools import wraps
+
+try:
+    from dulwich.diff_tree import tree_changes
+    from dulwich.index import IndexEntry, blob_from_path_and_stat, cleanup_mode
+    from dulwich.objects import Tag
+    from dulwich.repo import Repo
+except ImportError:
+    Repo = None
+
+# Bit of an index entry's extended flags set for skip-worktree files
+SKIP_WORKTREE = 0x4000
+
+# Mode of submodules in the index
+GITLINK_MODE = 0o160000
+
+# Commits walked to check whether one is an ancestor of another, before
+# asking git, which can use its commit-graph, instead
+MAX_ANCESTRY_WALK = 1000
+
+
+class ChangeSet:
+    """
+    Files changed between two commits, parsed from
+    `git diff --name-status --no-renames -z`
+
+    Attributes:
+        changes (dict): Maps each kind of change, the status letter git
+            uses (e.g. 'A' for added, 'D' for deleted), to the set of paths
+            changed that way
+    """
+    def __init__(self, changes=None):
+        self.changes = changes or {}
+
+    @classmethod
+    def parse(cls, output):
+        # Output is `<status>\0<path>\0` for each changed path
+        fields = output.split('\0')
+        changes = {}
+        for status, path in zip(fields[0::2], fields[1::2]):
+            changes.setdefault(status[0], set()).add(path)
+        return cls(changes)
+
+    def paths(self, kind=None):
+        """
+        Return the set of paths changed in the given way, or in any way if
+        kind is None
+        """
+        if kind is not None:
+            return self.changes.get(kind, set())
+        return set().union(*self.changes.values())
+
+    def filter(self, predicate):
+        """
+        Return a ChangeSet of the paths for which predicate(path) is true
+        """
+        return ChangeSet({
+            kind: {path for path in paths if predicate(path)}
+            for kind, paths in self.changes.items()
+        })
+
+
+def git_output(cmd, repo_dir, **kwargs):
+    return subprocess.check_output(cmd, cwd=repo_dir, env=dict(os.environ, LANG='C'), **kwargs).decode()
+
+
+def git_succeeds(cmd, repo_dir):
+    """
+    Return true if cmd exits successfully. Its error messages are dropped,
+    since failing is an answer.
+    """
+    try:
+        git_output(cmd, repo_dir, stderr=subprocess.DEVNULL)
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+class GitCLIBackend:
+    """
+    Answers questions about a clone by running git.
+
+    Every method blocks until git is done, so GitPuller steps call them
+    through Call.
+    """
+    name = 'cli'
+
+    def is_ancestor(self, repo_dir, commit, descendant):
+        """
+        Return true if commit is descendant or one of its ancestors. False if
+        either of them doesn't exist.
+        """
+        return git_succeeds(['git', 'merge-base', '--is-ancestor', commit, descendant], repo_dir)
+
+    def has_unstaged_changes(self, repo_dir):
+        """
+        Return true if tracked files in the working tree differ from the index
+        """
+        return not git_succeeds(['git', 'diff-files', '--quiet'], repo_dir)
+
+    def has_staged_changes(self, repo_dir):
+        """
+        Return true if the index differs from HEAD
+        """
+        return not git_succeeds(['git', 'diff-index', '--cached', '--quiet', 'HEAD'], repo_dir)
+
+    def deleted_files(self, repo_dir):
+        """
+        Return the list of tracked files missing from the working tree
+        """
+        output = git_output(['git', 'ls-files', '--deleted', '-z'], repo_dir)
+        return [path for path in output.split('\0') if path]
+
+    def diff(self, repo_dir, old, new):
+        """
+        Return the ChangeSet between commits old and new
+        """
+        return ChangeSet.parse(git_output(
+            ['git', 'diff', '--name-status', '--no-renames', '-z', old, new], repo_dir
+        ))
+
+    def get_config(self, repo_dir, name):
+        """
+        Return the value of the config variable name, or None if it isn't set
+        """
+        try:
+            return git_output(['git', 'config', '--get', name], repo_dir).rstrip('\n')
+        except subprocess.CalledProcessError:
+            return None
+
+
+def falls_back(method):
+    """
+    Make a DulwichBackend method ask git instead if dulwich can't answer,
+    for example for repository features it doesn't support
+    """
+    @wraps(method)
+    def wrapper(self, repo_dir, *args):
+        try:
+            return method(self, repo_dir, *args)
+        except Exception:
+            logging.debug('dulwich could not answer {} in {}, asking git'.format(
+                method.__name__, repo_dir
+            ), exc_info=True)
+            return getattr(GitCLIBackend, method.__name__)(self, repo_dir, *args)
+    return wrapper
+
+
+class DulwichBackend(GitCLIBackend):
+    """
+    Answers questions about a clone in process with dulwich, falling back
+    to git when it can't
+    """
+    name = 'dulwich'
+
+    def resolve(self, repo, rev):
+        """
+        Return the id of the commit rev (a SHA, HEAD, or the name of a remote
+        tracking branch, branch or tag) points to, or None
+        """
+        if re.fullmatch('[0-9a-f]{40}', rev):
+            sha = rev.encode()
+        else:
+            for ref in (rev, 'refs/remotes/' + rev, 'refs/heads/' + rev, 'refs/tags/' + rev):
+                try:
+                    sha = repo.refs[ref.encode()]
+                    break
+                except KeyError:
+                    continue
+            else:
+                return None
+        try:
+            obj = repo[sha]
+            while isinstance(obj, Tag):
+                obj = repo[obj.object[1]]
+        except KeyError:
+            return None
+        return obj.id
+
+    def index_entries(self, repo):
+        """
+        Yield the path and IndexEntry of each file git doesn't skip
+        """
+        for path, entry in repo.open_index().items():
+            if not isinstance(entry, IndexEntry):
+                # Only unmerged entries aren't IndexEntries
+                raise ValueError('{} is unmerged'.format(path))
+            if getattr(entry, 'extended_flags', 0) & SKIP_WORKTREE or entry.mode == GITLINK_MODE:
+                # Skipped files and submodules
+                continue
+            yield os.fsdecode(path), entry
+
+    @falls_back
+    def is_ancestor(self, repo_dir, commit, descendant):
+        with Repo(repo_dir) as repo:
+            target = self.resolve(repo, commit)
+            start = self.resolve(repo, descendant)
+            if target is None or start is None:
+                return False
+            shallow = repo.get_shallow()
+            seen = set()
+            todo = [start]
+            while todo:
+                sha = todo.pop()
+                if sha == target:
+                    return True
+                if sha in seen or sha in shallow:
+                    continue
+                seen.add(sha)
+                if len(seen) > MAX_ANCESTRY_WALK:
+                    raise RuntimeError('History too long to walk')
+                todo.extend(repo[sha].parents)
+            return False
+
+    @falls_back
+    def has_unstaged_changes(self, repo_dir):
+        with Repo(repo_dir) as repo:
+            index_mtime = int(os.stat(repo.index_path()).st_mtime)
+            for path, entry in self.index_entries(repo):
+                fs_path = os.path.join(repo_dir, path)
+                try:
+                    st = os.lstat(fs_path)
+                except FileNotFoundError:
+                    return True
+                if cleanup_mode(st.st_mode) != entry.mode or st.st_size & 0xFFFFFFFF != entry.size:
+                    return True
+                mtime = entry.mtime[0] if isinstance(entry.mtime, tuple) else int(entry.mtime)
+                # Like git, only trust the timestamp if the file wasn't
+                # changed around the time the index was written
+                if int(st.st_mtime) == mtime and mtime < index_mtime:
+                    continue
+                if blob_from_path_and_stat(os.fsencode(fs_path), st).id != entry.sha:
+                    return True
+            return False
+
+    @falls_back
+    def has_staged_changes(self, repo_dir):
+        with Repo(repo_dir) as repo:
+            tree = repo[repo.head()].tree
+            return any(True for _ in repo.open_index().changes_from_tree(repo.object_store, tree))
+
+    @falls_back
+    def deleted_files(self, repo_dir):
+        with Repo(repo_dir) as repo:
+            return [
+                path for path, _ in self.index_entries(repo)
+                if not os.path.lexists(os.path.join(repo_dir, path))
+            ]
+
+    @falls_back
+    def diff(self, repo_dir, old, new):
+        kinds = {'add': 'A', 'delete': 'D', 'modify': 'M'}
+        with Repo(repo_dir) as repo:
+            trees = []
+            for rev in (old, new):
+                sha = self.resolve(repo, rev)
+                if sha is None:
+                    raise KeyError(rev)
+                trees.append(repo[sha].tree)
+            changes = {}
+            for change in tree_changes(repo.object_store, *trees):
+                if change.type not in kinds:
+                    raise ValueError('Unexpected change {}'.format(change.type))
+                entry = change.old if change.type == 'delete' else change.new
+                changes.setdefault(kinds[change.type], set()).add(os.fsdecode(entry.path))
+            return ChangeSet(changes)
+
+    @falls_back
+    def get_config(self, repo_dir, name):
+        section, _, key = name.rpartition('.')
+        section = tuple(part.encode() for part in section.split('.', 1))
+        with Repo(repo_dir) as repo:
+            try:
+                # Includes the user's and system config, like git does
+                return repo.get_config_stack().get(section, key.encode()).decode()
+            except KeyError:
+                return None
+
+
+def get_backend(name):
+    """
+    Return the backend called name, or GitCLIBackend if it can't be used
+    """
+    if name == 'dulwich':
+        if Repo is not None:
+            return DulwichBackend()
+        logging.warning('dulwich is not installed, using the git command line instead')
+    return GitCLIBackend()
@@ -0,0 +1,185 @@
+"""
+Sync many repositories into many directories at once, for example to fill the
+home directories of a class before it starts.
+
+The targets are read from a manifest, a CSV file with a header row or a JSON
+list of objects, with these fields:
+
+- url: URL of the repository
+- target: directory to sync it into
+- branch: branch to sync, optional, the remote's default branch otherwise
+- depth: depth of the clone, optional
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import time
+
+from nbgitpuller.cache import redact_url
+from nbgitpuller.errors import GitPullerError
+from nbgitpuller.pull import GitPuller
+
+
+def read_manifest(path, root='.'):
+    """
+    Read the targets listed in the manifest at path, a .json file or a CSV
+    file. Relative target directories are relative to root.
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+
+    targets = []
+    seen = set()
+    for n, row in enumerate(rows, 1):
+        url = (row.get('url') or '').strip()
+        target = (row.get('target') or '').strip()
+        if not url or not target:
+            raise ValueError('Entry {} of {} needs a url and a target'.format(n, path))
+        target = os.path.join(root, target)
+        if os.path.realpath(target) in seen:
+            raise ValueError('Entry {} of {} syncs into {} again'.format(n, path, target))
+        seen.add(os.path.realpath(target))
+        # 0 means a full clone, unlike a missing depth
+        depth = row.get('depth')
+        depth = None if depth in (None, '') else int(depth)
+        targets.append({
+            'url': url,
+            'branch': (row.get('branch') or '').strip() or None,
+            'target': target,
+            'depth': depth,
+        })
+    return targets
+
+
+def read_synced(path):
+    """
+    Return the (url, branch, target) of the targets an earlier run, whose
+    summary was written to path, synced successfully
+    """
+    with open(path) as f:
+        summary = json.load(f)
+    return {
+        (result['url'], result['branch'], result['target'])
+        for result in summary['targets']
+        if result['status'] in ('ok', 'skipped')
+    }
+
+
+def sync_target(target):
+    """
+    Pull a target from the manifest, returning a dict describing how it went
+
+    This runs in the worker processes.
+    """
+    result = {
+        'url': redact_url(target['url']),
+        'branch': target['branch'],
+        'target': target['target'],
+    }
+    start = time.perf_counter()
+    try:
+        gp = GitPuller(target['url'], target['target'], branch=target['branch'], depth=target['depth'])
+        for line in gp.pull():
+            logging.debug(line.rstrip())
+    except Exception as e:
+        err = GitPullerError.from_exception(e)
+        logging.error('Failed to sync {}:\n{}'.format(target['target'], err.traceback or err))
+        result.update(status='failed', error={'code': err.code, 'message': err.message})
+    else:
+        result.update(status='ok', pull_type=gp.pull_type, timings=gp.timings.to_dict())
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def init_worker(level):
+    logging.basicConfig(format='[%(asctime)s] %(levelname)s -- %(message)s', level=level)
+
+
+def sync_targets(targets, workers, synced=(), level=logging.INFO):
+    """
+    Sync targets in a pool of worker processes, returning the result of each
+    one in the same order. Targets in synced, as returned by read_synced, are
+    skipped.
+    """
+    results = [None] * len(targets)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker, initargs=(level,)) as pool:
+        futures = {}
+        for i, target in enumerate(targets):
+            if (redact_url(target['url']), target['branch'], target['target']) in synced:
+                results[i] = {
+                    'url': redact_url(target['url']),
+                    'branch': target['branch'],
+                    'target': target['target'],
+                    'status': 'skipped',
+                    'seconds': 0,
+                }
+            else:
+                futures[pool.submit(sync_target, target)] = i
+        for future in concurrent.futures.as_completed(futures):
+            result = results[futures[future]] = future.result()
+            logging.info('{:<7} {:>8.2f}s  {:<12} {}'.format(
+                result['status'], result['seconds'], result.get('pull_type', ''), result['target']
+            ))
+    return results
+
+
+def summarize(results, seconds, workers):
+    """
+    Return the summary of a run that took seconds and produced results
+    """
+    counts = {}
+    pull_types = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        if 'pull_type' in result:
+            pull_types[result['pull_type']] = pull_types.get(result['pull_type'], 0) + 1
+    return {
+        'seconds': round(seconds, 3),
+        'workers': workers,
+        'counts': counts,
+        'pull_types': pull_types,
+        'targets': results,
+    }
+
+
+def main():
+    """
+    Syncs the repositories listed in a manifest into their directories.
+    """
+    parser = argparse.ArgumentParser(description='Syncs the repositories listed in a manifest into their directories, several at a time.')
+    parser.add_argument('manifest', help='CSV or .json file listing the url, target, branch and depth of each sync')
+    parser.add_argument('--root', default='.', help='Directory relative targets in the manifest are in')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of syncs to run at once')
+    parser.add_argument('--output', help='Write the JSON summary of the syncs to this file as well')
+    parser.add_argument('--resume', help='Summary of an earlier run, whose successful syncs are skipped')
+    parser.add_argument('--verbose', action='store_true', default=False, help='Log the output of git')
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.verbose else logging.INFO
+    init_worker(level)
+    try:
+        targets = read_manifest(args.manifest, args.root)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    synced = read_synced(args.resume) if args.resume else set()
+
+    start = time.perf_counter()
+    results = sync_targets(targets, args.workers, synced, level)
+    summary = summarize(results, time.perf_counter() - start, args.workers)
+
+    output = json.dumps(summary, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    return 1 if summary['counts'].get('failed') else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
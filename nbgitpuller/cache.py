@@ -0,0 +1,168 @@
+"""
+Caches shared between all the nbgitpuller processes on a node
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+def url_key(url):
+    """
+    Return a filesystem safe key identifying the remote at url
+    """
+    return hashlib.sha256(url.encode('utf8')).hexdigest()
+
+
+def mirror_path(mirror_dir, url):
+    """
+    Return the path of the mirror of the remote at url in mirror_dir
+    """
+    return os.path.join(mirror_dir, url_key(url) + '.git')
+
+
+def redact_url(url):
+    """
+    Strip any credentials from url, so it can be stored or displayed
+    """
+    parts = urlsplit(url)
+    if parts.username is None and parts.password is None:
+        return url
+    netloc = parts.hostname or ''
+    if parts.port:
+        netloc = '{}:{}'.format(netloc, parts.port)
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive advisory lock on path for the duration of the context
+
+    The lock file is created if needed, and made writable by everyone so
+    processes running as other users on the node can take the lock too. If
+    blocking is false and another process holds the lock, BlockingIOError is
+    raised instead of waiting for it.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        try:
+            os.fchmod(fd, 0o666)
+        except PermissionError:
+            # Created by another user, who already made it shareable
+            pass
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(path, data):
+    """
+    Write data as JSON to path, so readers only ever see a complete file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.chmod(tmp_path, 0o666)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class RefCache:
+    """
+    On-disk cache of the refs advertised by remotes, keyed by remote URL.
+
+    Entries are JSON files in a directory shared by every nbgitpuller process
+    on the node. The lock held while an entry is refreshed means that when
+    many servers ask about the same remote at once, only one of them talks
+    to the remote and the others read its answer. Failures to list the refs
+    are remembered for failure_ttl seconds, so when the remote is down the
+    processes waiting for the lock don't each wait for it to fail in turn.
+    Each entry also counts its hits and misses.
+    """
+    def __init__(self, path, ttl, failure_ttl=10):
+        self.path = path
+        self.ttl = ttl
+        self.failure_ttl = min(failure_ttl, ttl)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, url):
+        return os.path.join(self.path, url_key(url) + '.json')
+
+    def _read(self, entry_path):
+        try:
+            with open(entry_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, url, fetch, refresh=False):
+        """
+        Return the cached refs of url, calling fetch() to refresh them if
+        they are missing or older than the TTL, or if refresh is true.
+
+        fetch must return something JSON serializable. If it raises
+        subprocess.CalledProcessError, the same error is raised again for
+        failure_ttl seconds instead of calling fetch. Other exceptions are not
+        cached.
+        """
+        entry_path = self._entry_path(url)
+        with file_lock(entry_path + '.lock'):
+            entry = self._read(entry_path) or {'hits': 0, 'misses': 0}
+            entry['url'] = redact_url(url)
+            failure = entry.get('failure')
+            if not refresh and 'refs' in entry and time.time() - entry['fetched'] < self.ttl:
+                entry['hits'] += 1
+                logging.info('Ref cache hit for {}'.format(redact_url(url)))
+            elif not refresh and failure and time.time() - failure['at'] < self.failure_ttl:
+                entry['hits'] += 1
+                logging.info('Ref cache hit for {}, which recently failed'.format(redact_url(url)))
+                write_json_atomic(entry_path, entry)
+                raise subprocess.CalledProcessError(
+                    failure['returncode'], failure['cmd'], failure['output'], failure['stderr']
+                )
+            else:
+                entry['misses'] += 1
+                logging.info('Ref cache miss for {}'.format(redact_url(url)))
+                try:
+                    entry['refs'] = fetch()
+                except subprocess.CalledProcessError as e:
+                    entry['failure'] = {
+                        'at': time.time(),
+                        'returncode': e.returncode,
+                        'cmd': [arg.replace(url, redact_url(url)) for arg in e.cmd],
+                        'output': e.output if isinstance(e.output, str) else None,
+                        'stderr': e.stderr if isinstance(e.stderr, str) else None,
+                    }
+                    write_json_atomic(entry_path, entry)
+                    raise
+                entry['fetched'] = time.time()
+                entry.pop('failure', None)
+            write_json_atomic(entry_path, entry)
+        return entry['refs']
+
+    def stats(self):
+        """
+        Return the hit and miss counters of every cached remote, keyed by URL
+        """
+        stats = {}
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            entry = self._read(os.path.join(self.path, name))
+            if entry:
+                stats[entry['url']] = {'hits': entry['hits'], 'misses': entry['misses']}
+        return stats
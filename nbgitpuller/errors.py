@@ -2,6 +2,20 @@ import subprocess
 import traceback
 
 
+def git_subcommand(cmd):
+    """
+    Return the subcommand of a git command line, skipping the options before
+    it like `-c name=value`
+    """
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg == "-c":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
 class GitPullerError(Exception):
     """
     Structured error class used to branch frontend UI content based on its attributes.
@@ -50,12 +64,13 @@ class GitPullerError(Exception):
         traceback_message = cls.format_traceback(exc)
         if isinstance(exc, subprocess.CalledProcessError):
             # Categorise errors based on specific git commands
-            if exc.cmd[1] == "clone":
+            subcommand = git_subcommand(exc.cmd)
+            if subcommand == "clone":
                 return CloneError(traceback_message)
-            elif len(exc.cmd) >5 and exc.cmd[5] == "merge":
+            elif subcommand in ("merge", "merge-tree", "read-tree"):
                 return MergeError(traceback_message)
-            elif exc.cmd[1] == "ls-remote":
-                return RemoteError(traceback_message)                
+            elif subcommand in ("ls-remote", "fetch"):
+                return RemoteError(traceback_message)
         return cls(code="unknown", message=str(exc), traceback_message=traceback_message)
 
 
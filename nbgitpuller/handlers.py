@@ -1,14 +1,21 @@
-from tornado import gen, web, locks
+import asyncio
+import collections
+import itertools
+import time
+import zlib
+from tornado import web, locks
+from tornado.ioloop import IOLoop
 import traceback
 import urllib.parse
 
-import threading
 import json
 import os
-from queue import Queue, Empty
+from functools import partial
 import jinja2
 
-from nbgitpuller.pull import GitPuller
+from nbgitpuller import metrics
+from nbgitpuller.pull import GitPuller, Timings
+from nbgitpuller.progress import ProgressCollapser
 from nbgitpuller.errors import GitPullerError
 from nbgitpuller.version import __version__
 from nbgitpuller._compat import get_base_handler
@@ -16,19 +23,160 @@ from nbgitpuller._compat import get_base_handler
 JupyterHandler = get_base_handler()
 
 
+# Output published this close together, in seconds, is sent to the browser
+# as a single event
+BATCH_INTERVAL = 0.1
+
+# ...unless it adds up to more than this many characters
+BATCH_SIZE = 64 * 1024
+
+# Output kept for requests that fall behind or attach late, in characters.
+# Older output is left out past that.
+BUFFER_SIZE = 1024 * 1024
+
 jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(
         os.path.join(os.path.dirname(__file__), 'templates')
     ),
 )
 
+def link_subpath(url_path, parent_reldir, targetpath):
+    """
+    Return the path inside the repository cloned into targetpath that
+    url_path opens, or None if it isn't a path inside the repository.
+    url_path and targetpath may be percent-encoded.
+    """
+    path = urllib.parse.unquote(urllib.parse.urlsplit(url_path).path.strip('/'))
+    targetpath = urllib.parse.unquote(targetpath)
+    for prefix in ('lab/tree/', 'tree/', 'notebooks/', 'edit/', 'voila/render/'):
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+            break
+    else:
+        return None
+    repo_path = os.path.normpath(os.path.join(parent_reldir, targetpath)).replace(os.sep, '/')
+    if not path.startswith(repo_path + '/'):
+        return None
+    return path[len(repo_path) + 1:]
+
+
+def output_size(event):
+    return len(event.get('output', ''))
+
+
+def is_output(event):
+    """
+    Return true if event only carries output, and can be merged with others
+    """
+    return event['phase'] == 'syncing' and set(event) <= {'phase', 'output', 'progress'}
+
+
+def coalesce(events):
+    """
+    Merge each run of consecutive output events into a single event
+    """
+    merged = []
+    for output, run in itertools.groupby(events, is_output):
+        run = list(run)
+        if not output or len(run) == 1:
+            merged.extend(run)
+            continue
+        event = {'phase': 'syncing', 'output': ''.join(e['output'] for e in run)}
+        progress = [e['progress'] for e in run if 'progress' in e]
+        if progress:
+            event['progress'] = progress[-1]
+        merged.append(event)
+    return merged
+
+
+class SyncOperation:
+    """
+    A sync that one or more SyncHandler requests are following.
+
+    Events published are kept, so requests that attach while the sync is
+    running get everything produced so far replayed, and then follow the live
+    stream. Only the last max_size characters of output are kept. Requests
+    that fall further behind, or attach later, are told how many lines were
+    left out instead.
+    """
+    def __init__(self, log, max_size=BUFFER_SIZE):
+        self.log = log
+        self.max_size = max_size
+        self.events = collections.deque()
+        # Number of events dropped from the start of self.events
+        self.dropped = 0
+        self.size = 0
+        self.done = False
+        self.task = None
+        self._changed = locks.Condition()
+
+    def publish(self, data):
+        if self.done:
+            return
+        if 'output' in data:
+            self.log.info(data['output'].rstrip())
+        self.events.append(data)
+        self.size += output_size(data)
+        while self.size > self.max_size and len(self.events) > 1:
+            self.size -= output_size(self.events.popleft())
+            self.dropped += 1
+        if data['phase'] in ('finished', 'error'):
+            self.done = True
+        self._changed.notify_all()
+
+    async def follow(self, interval=BATCH_INTERVAL, max_size=BATCH_SIZE):
+        """
+        Yield every event of the sync, from the first one until it is done,
+        in lists
+
+        Events are collected for up to interval seconds after the first one
+        of a list, or until they hold max_size characters of output, and
+        consecutive output is merged into a single event. A chatty git
+        command is then sent in a few large writes rather than many small
+        ones.
+        """
+        i = 0
+        while True:
+            batch = []
+            size = 0
+            deadline = None
+            while True:
+                if i < self.dropped:
+                    batch.append({
+                        'phase': 'syncing',
+                        'output': '[{} lines of output left out]\n'.format(self.dropped - i),
+                    })
+                    i = self.dropped
+                while i < self.dropped + len(self.events):
+                    event = self.events[i - self.dropped]
+                    batch.append(event)
+                    size += output_size(event)
+                    i += 1
+                if self.done or size >= max_size:
+                    break
+                if not batch:
+                    await self._changed.wait()
+                    continue
+                if deadline is None:
+                    deadline = IOLoop.current().time() + interval
+                if not await self._changed.wait(deadline):
+                    break
+            yield coalesce(batch)
+            if self.done and i == self.dropped + len(self.events):
+                return
+
+
 class SyncHandler(JupyterHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # We use this lock to make sure that only one sync operation
-        # can be happening at a time. Git doesn't like concurrent use!
-        if 'git_lock' not in self.settings:
-            self.settings['git_lock'] = locks.Lock()
+        # We use these locks to make sure that only one sync operation can be
+        # happening in a given directory at a time. Git doesn't like
+        # concurrent use! Syncs into different directories can run in parallel.
+        if 'git_locks' not in self.settings:
+            self.settings['git_locks'] = {}
+        # Syncs currently running, so identical requests can share them
+        if 'git_syncs' not in self.settings:
+            self.settings['git_syncs'] = {}
 
     def get_login_url(self):
         # raise on failed auth, not redirect
@@ -36,37 +184,64 @@ class SyncHandler(JupyterHandler):
         # same as Jupyter's APIHandler
         raise web.HTTPError(403)
 
-    @property
-    def git_lock(self):
-        return self.settings['git_lock']
-
-    async def emit(self, data):
-        if type(data) is not str:
-            serialized_data = json.dumps(data)
-            if 'output' in data:
-                self.log.info(data['output'].rstrip())
-        else:
-            serialized_data = data
-            self.log.info(data)
-        self.write('data: {}\n\n'.format(serialized_data))
+    def git_lock(self, repo_dir):
+        """
+        Return the lock guarding git operations in repo_dir
+        """
+        return self.settings['git_locks'].setdefault(os.path.realpath(repo_dir), asyncio.Lock())
+
+    async def emit(self, *events):
+        """
+        Send events to the browser, each as a server-sent event
+        """
+        chunk = []
+        for data in events:
+            if type(data) is not str:
+                serialized_data = json.dumps(data)
+            else:
+                serialized_data = data
+                self.log.info(data)
+            chunk.append('data: {}\n\n'.format(serialized_data))
+        chunk = ''.join(chunk).encode('utf8')
+        if self.compressor is not None:
+            # Each write must be decompressible on its own
+            chunk = self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.write(chunk)
         await self.flush()
 
+    def start_compression(self):
+        """
+        Compress the event stream with gzip if the browser accepts it, unless
+        NBGITPULLER_COMPRESS_EVENTS is 0
+        """
+        self.compressor = None
+        if os.getenv('NBGITPULLER_COMPRESS_EVENTS', '1') == '0':
+            return
+        accepted = [
+            encoding.split(';')[0].strip()
+            for encoding in self.request.headers.get('Accept-Encoding', '').split(',')
+        ]
+        if 'gzip' in accepted:
+            self.set_header('content-encoding', 'gzip')
+            self.add_header('vary', 'Accept-Encoding')
+            self.compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
     @web.authenticated
     async def get(self):
-        try:
-            await self.git_lock.acquire(1)
-        except gen.TimeoutError:
-            await self.emit({
-                'phase': 'error',
-                'message': 'Another git operation is currently running, try again in a few minutes'
-            })
-            return
+        # We gonna send out event streams!
+        self.set_header('content-type', 'text/event-stream')
+        self.set_header('cache-control', 'no-cache')
+        # Reverse proxies like nginx would otherwise hold back events until
+        # they have buffered enough of them
+        self.set_header('x-accel-buffering', 'no')
+        self.start_compression()
 
         try:
             repo = self.get_argument('repo')
             branch = self.get_argument('branch', None)
             depth = self.get_argument('depth', None)
             backup = self.get_argument('backup', False)
+            subpath = self.get_argument('subpath', None)
             if depth:
                 depth = int(depth)
             # The default working directory is the directory from which Jupyter
@@ -82,75 +257,137 @@ class SyncHandler(JupyterHandler):
                                            os.getenv('NBGITPULLER_PARENTPATH', ''))
             repo_dir = os.path.join(repo_parent_dir, self.get_argument('targetpath', repo.split('/')[-1]))
 
-            # We gonna send out event streams!
-            self.set_header('content-type', 'text/event-stream')
-            self.set_header('cache-control', 'no-cache')
+            # Identical requests (a refreshed page, the same link opened in
+            # several tabs) follow the sync that is already running, rather
+            # than starting their own.
+            key = (repo, branch, depth, backup, subpath, os.path.realpath(repo_dir))
+            operation = self.settings['git_syncs'].get(key)
+            if operation is None:
+                operation = self.settings['git_syncs'][key] = SyncOperation(self.log)
+                operation.task = asyncio.ensure_future(self.run_sync(
+                    operation, key, repo, repo_dir, branch=branch, depth=depth, backup=backup, subpath=subpath
+                ))
+            else:
+                self.log.info('Following sync already running in {}'.format(repo_dir))
+                metrics.SHARED_SYNCS_TOTAL.inc()
+
+            async for events in operation.follow():
+                await self.emit(*events)
+        except Exception as e:
+            await self.emit(self.error_event(e))
+        if self.compressor is not None:
+            self.write(self.compressor.flush())
+
+    @staticmethod
+    def error_event(e):
+        return {
+            'phase': 'error',
+            'message': str(e),
+            'output': '\n'.join([
+                line.strip()
+                for line in traceback.format_exception(
+                    type(e), e, e.__traceback__
+                )
+            ])
+        }
+
+    async def run_sync(self, operation, key, repo, repo_dir, **kwargs):
+        """
+        Run a sync into repo_dir, publishing its progress to operation
 
+        This runs independently of the request that started it, so the sync
+        completes even if that request goes away.
+        """
+        try:
+            # Wait our turn if another sync into the same directory is running
+            git_lock = self.git_lock(repo_dir)
+            if git_lock.locked():
+                operation.publish({
+                    'phase': 'syncing',
+                    'output': 'Waiting for another git operation in {} to finish\n'.format(repo_dir),
+                })
+            wait_start = time.perf_counter()
             try:
-                gp = GitPuller(repo, repo_dir, branch=branch, depth=depth, backup=backup, parent=self.settings['nbapp'])
-            except Exception as e:
-                err = GitPullerError.from_exception(e)
-                err.traceback = GitPullerError.format_traceback(e)
-                err_out = err.to_dict()
-                await self.emit({
+                await asyncio.wait_for(git_lock.acquire(), float(os.getenv('NBGITPULLER_LOCK_TIMEOUT', 300)))
+            except asyncio.TimeoutError:
+                waited = time.perf_counter() - wait_start
+                metrics.LOCK_WAIT_SECONDS.observe(waited)
+                metrics.record_error('lock_timeout')
+                timings = Timings()
+                # Time spent waiting for another sync's git, not our own
+                timings.add('lock-wait', waited, 0.0)
+                operation.publish({
                     'phase': 'error',
-                    'message': err_out["message"],
-                    'error': err_out,
-                    'output': err_out["traceback"],
+                    'message': 'Another git operation is currently running, try again in a few minutes',
+                    'timings': timings.to_dict(),
                 })
-                raise err
-
+                return
+            metrics.LOCK_WAIT_SECONDS.observe(time.perf_counter() - wait_start)
 
-            q = Queue()
-
-            def pull():
-                try:
-                    for line in gp.pull():
-                        q.put_nowait(line)
-                    # Sentinel when we're done
-                    q.put_nowait(None)
-                except Exception as e:
-                    q.put_nowait(e)
-                    raise e
-            self.gp_thread = threading.Thread(target=pull)
-
-            self.gp_thread.start()
-
-            while True:
-                try:
-                    progress = q.get_nowait()
-                except Empty:
-                    await gen.sleep(0.5)
-                    continue
-                if progress is None:
-                    break
-                if isinstance(progress, Exception):
-                    e = GitPullerError.from_exception(progress)
-                    err = e.to_dict()
-                    await self.emit({
-                        'phase': 'error',
-                        'message': str(progress),
-                        'error': err,
-                        'output': err["traceback"]
-                    })
-                    raise e
-
-                await self.emit({'output': progress, 'phase': 'syncing'})
+            try:
+                await self.sync(operation, repo, repo_dir, **kwargs)
+            finally:
+                git_lock.release()
+        except Exception as e:
+            operation.publish(self.error_event(e))
+        finally:
+            del self.settings['git_syncs'][key]
+
+    async def sync(self, operation, repo, repo_dir, **kwargs):
+        """
+        Pull repo into repo_dir, publishing its progress to operation
+        """
+        start = time.perf_counter()
+        timings = Timings()
+        try:
+            # Resolving the branch may have to ask the remote, which can
+            # take a while. Do that in a thread so the rest of the server
+            # stays responsive in the meantime.
+            gp = await IOLoop.current().run_in_executor(None, partial(
+                GitPuller, repo, repo_dir, parent=self.settings['nbapp'], timings=timings, **kwargs
+            ))
+        except Exception as e:
+            err = GitPullerError.from_exception(e)
+            err.traceback = GitPullerError.format_traceback(e)
+            err_out = err.to_dict()
+            metrics.record_error(err.code)
+            metrics.record_phases(timings)
+            operation.publish({
+                'phase': 'error',
+                'message': err_out["message"],
+                'error': err_out,
+                'output': err_out["traceback"],
+                'timings': timings.to_dict(),
+            })
+            return
 
-            await self.emit({'phase': 'finished'})
+        output_bytes = 0
+        # Only pass on some of the lines git overwrites to show its progress
+        progress = ProgressCollapser()
+        try:
+            async for line in gp.pull_async():
+                output_bytes += len(line.encode('utf8'))
+                event = progress.event(line)
+                if event is not None:
+                    operation.publish(event)
         except Exception as e:
-            await self.emit({
+            err = GitPullerError.from_exception(e)
+            err_out = err.to_dict()
+            metrics.record_error(err.code)
+            metrics.record_phases(gp.timings)
+            operation.publish({
                 'phase': 'error',
                 'message': str(e),
-                'output': '\n'.join([
-                    line.strip()
-                    for line in traceback.format_exception(
-                        type(e), e, e.__traceback__
-                    )
-                ])
+                'error': err_out,
+                'output': err_out["traceback"],
+                'timings': gp.timings.to_dict(),
             })
+            return
         finally:
-            self.git_lock.release()
+            metrics.OUTPUT_BYTES_TOTAL.inc(output_bytes)
+
+        metrics.record_sync(gp, time.perf_counter() - start)
+        operation.publish({'phase': 'finished', 'pull_type': gp.pull_type, 'timings': gp.timings.to_dict()})
 
 
 class UIHandler(JupyterHandler):
@@ -188,6 +425,8 @@ class UIHandler(JupyterHandler):
         self.write(
             jinja_env.get_template('status.html').render(
                 repo=repo, branch=branch, path=path, depth=depth, targetpath=targetpath, backup=backup, version=__version__,
+                # Only what is being opened needs to be checked out
+                subpath=link_subpath(urlPath, parent_reldir, targetpath) if urlPath else subPath,
                 **self.template_namespace
             )
         )
@@ -0,0 +1,140 @@
+"""
+Placeholders for files that haven't been downloaded yet.
+
+When GitPuller.lazy_blob_limit is set, files larger than the limit aren't
+downloaded when a repository is cloned. A small placeholder file is written
+in their place instead, and git is told to ignore it with the skip-worktree
+bit. The placeholder is replaced by the real file the first time it is
+opened through the Jupyter contents manager.
+"""
+import asyncio
+import inspect
+import logging
+import os
+import subprocess
+import tempfile
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+PLACEHOLDER_HEADER = b'# nbgitpuller placeholder\n'
+
+# Placeholders are always smaller than this
+PLACEHOLDER_MAX_SIZE = 1024
+
+
+def write_placeholder(path, sha):
+    """
+    Write a placeholder for the blob sha at path
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(PLACEHOLDER_HEADER)
+        f.write(
+            'This file has not been downloaded yet. Open it in Jupyter to download it.\n'
+            'blob: {}\n'.format(sha).encode()
+        )
+
+
+def is_placeholder(path):
+    """
+    Return true if path is a placeholder written by write_placeholder
+    """
+    try:
+        if not os.path.isfile(path) or os.path.getsize(path) > PLACEHOLDER_MAX_SIZE:
+            return False
+        with open(path, 'rb') as f:
+            return f.read(len(PLACEHOLDER_HEADER)) == PLACEHOLDER_HEADER
+    except OSError:
+        return False
+
+
+def find_repo_dir(path):
+    """
+    Return the root of the git repository containing path, or None
+    """
+    path = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def materialize(path):
+    """
+    Replace the placeholder at path with the file it stands for, downloading
+    it from the remote. Returns true if the file was replaced.
+    """
+    if not is_placeholder(path):
+        return False
+    repo_dir = find_repo_dir(path)
+    if repo_dir is None:
+        return False
+    relpath = os.path.relpath(path, repo_dir).replace(os.sep, '/')
+    env = dict(os.environ, LANG='C')
+    try:
+        # Fetch the content before touching the placeholder, so a failed
+        # download leaves everything as it was
+        content = subprocess.check_output(
+            ['git', 'cat-file', '--filters', ':' + relpath], cwd=repo_dir, env=env
+        )
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.nbgitpuller-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        subprocess.check_call(
+            ['git', 'update-index', '--no-skip-worktree', '--', relpath], cwd=repo_dir, env=env
+        )
+    except (OSError, subprocess.CalledProcessError):
+        logging.exception('Could not download {}'.format(path))
+        return False
+    logging.info('Downloaded {}'.format(path))
+    return True
+
+
+def install_contents_hook(app):
+    """
+    Make app's contents manager replace placeholders by the files they stand
+    for before their content is read
+    """
+    contents_manager = app.contents_manager
+    get_os_path = getattr(contents_manager, '_get_os_path', None)
+    if get_os_path is None:
+        app.log.info('nbgitpuller: placeholders are not supported by {}'.format(
+            type(contents_manager).__name__
+        ))
+        return
+    get = contents_manager.get
+
+    if inspect.iscoroutinefunction(get):
+        async def get_materialized(path, content=True, *args, **kwargs):
+            os_path = get_os_path(path) if content else None
+            if os_path and is_placeholder(os_path):
+                # Don't run git in the repository while a sync does
+                repo_dir = os.path.realpath(find_repo_dir(os_path) or os_path)
+                git_locks = app.web_app.settings.setdefault('git_locks', {})
+                async with git_locks.setdefault(repo_dir, asyncio.Lock()):
+                    await IOLoop.current().run_in_executor(None, partial(materialize, os_path))
+            return await get(path, content, *args, **kwargs)
+    else:
+        # Downloading would block the whole server, and couldn't wait for a
+        # sync running in the same repository. Placeholders are left as they
+        # are.
+        def get_materialized(path, content=True, *args, **kwargs):
+            if content:
+                os_path = get_os_path(path)
+                if is_placeholder(os_path):
+                    app.log.warning(
+                        'nbgitpuller: not downloading {}, this needs an asynchronous contents manager'.format(os_path)
+                    )
+            return get(path, content, *args, **kwargs)
+
+    contents_manager.get = get_materialized
@@ -0,0 +1,80 @@
+"""
+Prometheus metrics exported by nbgitpuller
+
+They are registered in prometheus_client's default registry, which the Jupyter
+server exposes at its /metrics endpoint along with its own metrics.
+
+Read https://prometheus.io/docs/practices/naming/ for naming
+conventions for metrics & labels.
+"""
+from prometheus_client import Counter, Histogram
+
+from nbgitpuller.cache import redact_url
+
+# Syncs take from a few milliseconds (already up to date) to several minutes
+# (cloning a large repository from a slow host)
+SYNC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+SYNC_DURATION_SECONDS = Histogram(
+    'nbgitpuller_sync_duration_seconds',
+    'duration in seconds of syncs, by remote and how the pull went',
+    ['remote', 'pull_type'],
+    buckets=SYNC_BUCKETS,
+)
+
+SYNC_PHASE_DURATION_SECONDS = Histogram(
+    'nbgitpuller_sync_phase_duration_seconds',
+    'duration in seconds of each phase of a sync',
+    ['phase'],
+    buckets=SYNC_BUCKETS,
+)
+
+SYNCS_TOTAL = Counter(
+    'nbgitpuller_syncs_total',
+    'counter for syncs by how the pull went: clone, up-to-date, fast-forward or merge',
+    ['pull_type'],
+)
+
+SYNC_ERRORS_TOTAL = Counter(
+    'nbgitpuller_sync_errors_total',
+    'counter for failed syncs by error code',
+    ['code'],
+)
+
+SHARED_SYNCS_TOTAL = Counter(
+    'nbgitpuller_shared_syncs_total',
+    'counter for sync requests that followed an identical sync already running',
+)
+
+LOCK_WAIT_SECONDS = Histogram(
+    'nbgitpuller_lock_wait_seconds',
+    'time in seconds syncs waited for another sync in the same directory',
+    buckets=SYNC_BUCKETS,
+)
+
+OUTPUT_BYTES_TOTAL = Counter(
+    'nbgitpuller_output_bytes_total',
+    'bytes of git output produced by syncs',
+)
+
+
+def record_sync(gp, duration):
+    """
+    Record a successful sync by GitPuller gp, which took duration seconds
+    """
+    pull_type = gp.pull_type or 'unknown'
+    SYNCS_TOTAL.labels(pull_type=pull_type).inc()
+    SYNC_DURATION_SECONDS.labels(remote=redact_url(gp.git_url), pull_type=pull_type).observe(duration)
+    record_phases(gp.timings)
+
+
+def record_phases(timings):
+    """
+    Record the wall time of each phase in timings
+    """
+    for phase, totals in timings.phases.items():
+        SYNC_PHASE_DURATION_SECONDS.labels(phase=phase).observe(totals['wall'])
+
+
+def record_error(code):
+    SYNC_ERRORS_TOTAL.labels(code=code).inc()
@@ -0,0 +1,107 @@
+"""
+Keep bare mirrors of remote repositories up to date, for GitPuller to fetch
+from instead of the remotes themselves.
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from nbgitpuller.cache import file_lock, mirror_path, redact_url
+from nbgitpuller.pull import execute_cmd
+
+
+def run(cmd, **kwargs):
+    for line in execute_cmd(cmd, **kwargs):
+        logging.debug(line.rstrip())
+
+
+def update_mirror(mirror_dir, url):
+    """
+    Bring the mirror of url in mirror_dir up to date, creating it if needed,
+    and return its path.
+    """
+    path = mirror_path(mirror_dir, url)
+    with file_lock(path + '.lock'):
+        if os.path.exists(path):
+            logging.info('Updating mirror of {}'.format(redact_url(url)))
+            run(['git', 'fetch', '--prune', '--prune-tags', 'origin'], cwd=path)
+            return path
+
+        logging.info('Creating mirror of {}'.format(redact_url(url)))
+        # Clone next to path and move it in place once complete, so pullers
+        # never see a partial mirror
+        tmp_path = tempfile.mkdtemp(dir=mirror_dir, prefix='.tmp-')
+        try:
+            run(['git', 'clone', '--bare', '--', url, tmp_path])
+            # Only mirror branches and tags. `git clone --mirror` would also
+            # fetch refs pullers never use, like GitHub's refs/pull/*
+            for refspec in ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']:
+                run(['git', 'config', '--add', 'remote.origin.fetch', refspec], cwd=tmp_path)
+            os.chmod(tmp_path, 0o755)
+            os.rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+    return path
+
+
+def update_mirrors(mirror_dir, urls):
+    """
+    Update the mirrors of all urls, returning the number that failed
+    """
+    failed = 0
+    for url in urls:
+        try:
+            update_mirror(mirror_dir, url)
+        except subprocess.CalledProcessError:
+            logging.exception('Failed to update mirror of {}'.format(redact_url(url)))
+            failed += 1
+    return failed
+
+
+def read_repos_file(path):
+    """
+    Read repository URLs from path, one per line. Blank lines and lines
+    starting with `#` are ignored.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def main():
+    """
+    Keeps mirrors of git repositories up to date.
+    """
+    logging.basicConfig(
+        format='[%(asctime)s] %(levelname)s -- %(message)s',
+        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Keeps mirrors of git repositories up to date, for nbgitpuller to fetch from.')
+    parser.add_argument('mirror_dir', help='Directory to keep the mirrors in, GitPuller.mirror_dir should point here')
+    parser.add_argument('git_urls', nargs='*', help='Urls of the repos to mirror')
+    parser.add_argument('--repos-file', help='File listing urls of repos to mirror, one per line. It is read again before each update')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds to wait between updates')
+    parser.add_argument('--once', action='store_true', default=False, help='Update the mirrors once and exit')
+    args = parser.parse_args()
+
+    if not args.git_urls and not args.repos_file:
+        parser.error('no repos to mirror, pass git_urls or --repos-file')
+    os.makedirs(args.mirror_dir, exist_ok=True)
+
+    while True:
+        urls = list(args.git_urls)
+        if args.repos_file:
+            urls.extend(read_repos_file(args.repos_file))
+        failed = update_mirrors(args.mirror_dir, urls)
+        if args.once:
+            return 1 if failed else 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
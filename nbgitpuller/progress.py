@@ -0,0 +1,81 @@
+"""
+Progress of git clone and fetch, parsed from git's --progress output.
+
+git reports the progress of each stage of a transfer on a single terminal
+line that it keeps overwriting with `\r`, such as
+
+    remote: Counting objects:  45% (450/1000)
+    Receiving objects:  45% (450/1000), 3.00 MiB | 2.00 MiB/s
+
+A large clone writes thousands of these. ProgressCollapser turns them into a
+few progress events, which the status page shows as a progress bar.
+"""
+import re
+import time
+
+_PROGRESS_LINE = re.compile(
+    r'^(?:remote: )?(?P<stage>[A-Z][a-z]+(?: [a-z]+)*):\s+'
+    r'(?:(?P<percent>\d+)% \((?P<current>\d+)/(?P<total>\d+)\)|(?P<count>\d+))'
+    r'(?:, (?P<transferred>[\d.]+ (?:bytes|[KMGT]iB))(?: \| (?P<rate>[\d.]+ (?:bytes|[KMGT]iB)/s))?)?'
+    r'(?P<done>, done\.)?\s*$'
+)
+
+
+def parse_progress(line):
+    """
+    Parse a progress line written by git, returning a dict describing it,
+    or None if line isn't a progress line.
+
+    The dict has the stage of the transfer ('Receiving objects'), how far
+    along it is (percent, current and total, or only current if git doesn't
+    know the total), the amount of data transferred so far and the transfer
+    rate when git reports them (as git formats them, like '3.00 MiB' and
+    '2.00 MiB/s'), and whether the stage is done.
+    """
+    match = _PROGRESS_LINE.match(line)
+    if match is None:
+        return None
+    percent = match.group('percent')
+    return {
+        'stage': match.group('stage'),
+        'percent': int(percent) if percent is not None else None,
+        'current': int(match.group('current') or match.group('count')),
+        'total': int(match.group('total')) if match.group('total') is not None else None,
+        'transferred': match.group('transferred'),
+        'rate': match.group('rate'),
+        'done': match.group('done') is not None,
+    }
+
+
+class ProgressCollapser:
+    """
+    Turn the output lines of a pull into events for the status page,
+    collapsing the progress lines git overwrites with `\r`.
+
+    An overwritten progress line is only passed on when its stage starts,
+    or when its percentage changed and at least interval seconds passed
+    since the last one. The final line of each stage always is. Progress
+    lines passed on also carry the parsed progress.
+    """
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self._last = None
+        self._last_time = 0
+
+    def event(self, line):
+        """
+        Return the event to publish for output line, or None if it should be
+        left out
+        """
+        progress = parse_progress(line)
+        if progress is None:
+            return {'phase': 'syncing', 'output': line}
+        now = time.monotonic()
+        if line.endswith('\r') and not progress['done']:
+            stage_started = self._last is None or self._last[0] != progress['stage']
+            if not stage_started:
+                if self._last[1] == progress['percent'] or now - self._last_time < self.interval:
+                    return None
+        self._last = (progress['stage'], progress['percent'])
+        self._last_time = now
+        return {'phase': 'syncing', 'output': line, 'progress': progress}
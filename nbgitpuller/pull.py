@@ -1,14 +1,63 @@
+import asyncio
 import os
+import posixpath
+import re
+import shutil
 import subprocess
 import logging
+import tempfile
 import time
 import argparse
 import datetime
 from itertools import count
-from traitlets import Integer, default
+from traitlets import Bool, Enum, Float, Integer, Unicode, default
 from traitlets.config import Configurable
-from functools import partial
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from nbgitpuller.backends import get_backend
+from nbgitpuller.cache import RefCache, file_lock, mirror_path, url_key
 from nbgitpuller.errors import BranchExistError, BranchResolveError
+from nbgitpuller.lazy import is_placeholder, write_placeholder
+
+
+# Process output is read in chunks of this many bytes
+CHUNK_SIZE = 64 * 1024
+
+# Paths passed on a single git command line add up to at most this many bytes,
+# well under the operating system's limit on the size of arguments
+MAX_PATHS_BYTES = 64 * 1024
+
+# A line ends at `\n`, or at a `\r` that isn't part of a `\r\n` pair. A `\r`
+# at the very end of the buffer is only a line ending once we know which byte
+# comes after it.
+_LINE_ENDING = re.compile(rb'\n|\r(?=[^\n])')
+
+
+class LineSplitter:
+    """
+    Incrementally split chunks of output into lines.
+
+    This should behave the same as .readline(), but splits on `\r` OR `\n`,
+    not just `\n`. Lines are decoded as utf8 and keep their line endings.
+    """
+    def __init__(self):
+        self._buf = b''
+
+    def feed(self, chunk):
+        """
+        Add chunk to the buffer, returning the list of lines it completed
+        """
+        # Only rescan the tail of what's already buffered, a trailing `\r`
+        # might have been waiting for this chunk.
+        pos = max(len(self._buf) - 1, 0)
+        buf = self._buf + chunk
+        lines = []
+        start = 0
+        for match in _LINE_ENDING.finditer(buf, pos):
+            lines.append(buf[start:match.end()].decode('utf8', 'replace'))
+            start = match.end()
+        self._buf = buf[start:]
+        return lines
 
 
 def execute_cmd(cmd, **kwargs):
@@ -18,38 +67,385 @@ def execute_cmd(cmd, **kwargs):
     yield '$ {}\n'.format(' '.join(cmd))
     kwargs['stdout'] = subprocess.PIPE
     kwargs['stderr'] = subprocess.STDOUT
-    # Explicitly set LANG=C, as `git` commandline output will be different if
-    # the user environment has a different locale set!
-    kwargs['env'] = dict(os.environ, LANG='C')
+    kwargs['env'] = git_env()
 
     proc = subprocess.Popen(cmd, **kwargs)
 
     # Capture output for logging.
-    # Each line will be yielded as text.
-    # This should behave the same as .readline(), but splits on `\r` OR `\n`,
-    # not just `\n`.
-    buf = []
+    # Each line will be yielded as text, as soon as it is complete. read1
+    # returns whatever is available in the pipe rather than waiting for a
+    # full chunk.
+    splitter = LineSplitter()
+    try:
+        for chunk in iter(partial(proc.stdout.read1, CHUNK_SIZE), b''):
+            yield from splitter.feed(chunk)
+    finally:
+        ret = proc.wait()
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+
+
+async def execute_cmd_async(cmd, **kwargs):
+    """
+    Call given command on the running asyncio event loop, yielding output
+    line by line
+    """
+    yield '$ {}\n'.format(' '.join(cmd))
+    kwargs['stdout'] = asyncio.subprocess.PIPE
+    kwargs['stderr'] = asyncio.subprocess.STDOUT
+    kwargs['env'] = git_env()
 
-    def flush():
-        line = b''.join(buf).decode('utf8', 'replace')
-        buf[:] = []
-        return line
+    proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
 
-    c_last = ''
+    splitter = LineSplitter()
     try:
-        for c in iter(partial(proc.stdout.read, 1), b''):
-            if c_last == b'\r' and buf and c != b'\n':
-                yield flush()
-            buf.append(c)
-            if c == b'\n':
-                yield flush()
-            c_last = c
+        while True:
+            chunk = await proc.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            for line in splitter.feed(chunk):
+                yield line
     finally:
-        ret = proc.wait()
+        ret = await proc.wait()
         if ret != 0:
             raise subprocess.CalledProcessError(ret, cmd)
 
 
+def git_env():
+    """
+    Environment to run git in
+    """
+    # Explicitly set LANG=C, as `git` commandline output will be different if
+    # the user environment has a different locale set!
+    return dict(os.environ, LANG='C')
+
+
+def chunk_paths(paths, max_bytes=MAX_PATHS_BYTES):
+    """
+    Split paths into lists short enough to pass on a command line
+    """
+    chunk = []
+    size = 0
+    for path in paths:
+        path_size = len(path.encode('utf8', 'surrogateescape')) + 1
+        if chunk and size + path_size > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(path)
+        size += path_size
+    if chunk:
+        yield chunk
+
+
+@lru_cache(maxsize=None)
+def git_version():
+    """
+    Return the version of git as a tuple of ints, like (2, 39, 2)
+    """
+    output = subprocess.check_output(['git', '--version'], env=git_env()).decode()
+    return tuple(int(part) for part in re.findall(r'\d+', output)[:3])
+
+
+def normalize_subpath(subpath):
+    """
+    Return subpath as a path relative to the root of the repository, or None
+    if it refers to the whole repository or points outside of it
+    """
+    if not subpath:
+        return None
+    subpath = posixpath.normpath(subpath.replace(os.sep, '/')).strip('/')
+    if subpath in ('', '.') or subpath.startswith(('..', '-')):
+        return None
+    return subpath
+
+
+def in_sparse_cone(path, dirs):
+    """
+    Return true if path is checked out by a cone mode sparse checkout of dirs
+
+    Cone mode checks out everything under dirs, plus the files directly in
+    their parent directories (including the root).
+    """
+    parent = posixpath.dirname(path)
+    return parent == '' or any(
+        path.startswith(d + '/') or d.startswith(parent + '/') for d in dirs
+    )
+
+
+def parse_merge_tree(output):
+    """
+    Parse the output of `git merge-tree --write-tree -z`
+
+    Returns the merged tree, and a dict mapping each conflicted path to the
+    set of stages it has: 1 for the merge base, 2 for ours and 3 for theirs.
+    """
+    entries = output.split('\0')
+    conflicts = {}
+    # Conflicted files are listed after the tree, up to an empty entry
+    for entry in entries[1:entries.index('', 1)]:
+        info, path = entry.split('\t', 1)
+        conflicts.setdefault(path, set()).add(int(info.split()[2]))
+    return entries[0], conflicts
+
+
+
+class GitCommand:
+    """
+    A git command that one of the GitPuller steps wants to run.
+
+    Steps are generators yielding lines of output as strings. To run a
+    command, a step yields a GitCommand and gets its result sent back by
+    whatever is driving the steps. This lets the same steps run
+    synchronously (run_steps) or on an asyncio event loop (run_steps_async).
+
+    If stream is true, the command's output is passed on line by line while it
+    runs, and the result is the complete output. Otherwise the result is the
+    command's stdout. If the command fails, a CalledProcessError carrying that
+    output as a string is raised inside the step. input, if given, is passed
+    as bytes to the command's stdin, and requires stream to be false.
+    """
+    def __init__(self, cmd, cwd=None, stream=True, input=None):
+        assert input is None or not stream
+        self.cmd = cmd
+        self.cwd = cwd
+        self.stream = stream
+        self.input = input
+
+
+class Call:
+    """
+    A blocking function call requested by a GitPuller step, for work that
+    isn't a single git command. The result of func(*args, **kwargs) is sent
+    back into the step, and exceptions it raises are raised inside the step.
+
+    run_steps calls it directly, run_steps_async calls it in a thread so the
+    event loop isn't blocked.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self.func = partial(func, *args, **kwargs)
+
+
+class Timings:
+    """
+    Time spent in each phase of a pull, in seconds.
+
+    For each phase, wall is the time from its start to its end, and
+    subprocess the part of that spent waiting for the GitCommands and Calls
+    it yielded to finish. Phases that happen more than once are added up.
+    """
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, wall, waited):
+        totals = self.phases.setdefault(phase, {'wall': 0.0, 'subprocess': 0.0})
+        totals['wall'] += wall
+        totals['subprocess'] += waited
+
+    @contextmanager
+    def blocking(self, phase):
+        """
+        Time a block of code that only waits for git, so all of it counts
+        as subprocess time
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(phase, elapsed, elapsed)
+
+    def timed(self, phase, steps):
+        """
+        Run steps, passing everything they yield through, and add the time
+        they take to phase
+        """
+        start = time.perf_counter()
+        waited = 0.0
+        result = error = None
+        try:
+            while True:
+                try:
+                    item = steps.throw(error) if error else steps.send(result)
+                except StopIteration as e:
+                    return e.value
+                result = error = None
+                if isinstance(item, (GitCommand, Call)):
+                    item_start = time.perf_counter()
+                    try:
+                        result = yield item
+                    except Exception as e:
+                        error = e
+                    waited += time.perf_counter() - item_start
+                else:
+                    yield item
+        finally:
+            steps.close()
+            self.add(phase, time.perf_counter() - start, waited)
+
+    def to_dict(self):
+        return {
+            phase: {kind: round(seconds, 3) for kind, seconds in totals.items()}
+            for phase, totals in self.phases.items()
+        }
+
+    def format(self):
+        """
+        Return a table of the phases and their times, for printing
+        """
+        lines = ['{:<16} {:>9} {:>11}'.format('phase', 'wall (s)', 'subprocess')]
+        for phase, totals in self.phases.items():
+            lines.append('{:<16} {:>9.3f} {:>11.3f}'.format(phase, totals['wall'], totals['subprocess']))
+        return '\n'.join(lines)
+
+
+def run_steps(steps):
+    """
+    Run GitPuller steps synchronously, yielding their output line by line
+    """
+    result = error = None
+    try:
+        while True:
+            try:
+                item = steps.throw(error) if error else steps.send(result)
+            except StopIteration:
+                return
+            result = error = None
+            if isinstance(item, Call):
+                try:
+                    result = item.func()
+                except Exception as e:
+                    error = e
+                continue
+            if not isinstance(item, GitCommand):
+                yield item
+                continue
+            output = []
+            try:
+                if item.stream:
+                    for line in execute_cmd(item.cmd, cwd=item.cwd):
+                        output.append(line)
+                        yield line
+                    result = ''.join(output)
+                else:
+                    result = subprocess.check_output(
+                        item.cmd, cwd=item.cwd, env=git_env(), input=item.input
+                    ).decode()
+            except subprocess.CalledProcessError as e:
+                if item.stream:
+                    e.output = ''.join(output)
+                else:
+                    e.output = e.output.decode()
+                error = e
+    finally:
+        steps.close()
+
+
+async def run_steps_async(steps):
+    """
+    Run GitPuller steps on the running asyncio event loop, yielding their
+    output line by line
+    """
+    result = error = None
+    try:
+        while True:
+            try:
+                item = steps.throw(error) if error else steps.send(result)
+            except StopIteration:
+                return
+            result = error = None
+            if isinstance(item, Call):
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(None, item.func)
+                except Exception as e:
+                    error = e
+                continue
+            if not isinstance(item, GitCommand):
+                yield item
+                continue
+            output = []
+            try:
+                if item.stream:
+                    async for line in execute_cmd_async(item.cmd, cwd=item.cwd):
+                        output.append(line)
+                        yield line
+                    result = ''.join(output)
+                else:
+                    proc = await asyncio.create_subprocess_exec(
+                        *item.cmd, cwd=item.cwd, env=git_env(),
+                        stdin=None if item.input is None else asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.PIPE
+                    )
+                    stdout, _ = await proc.communicate(item.input)
+                    if proc.returncode != 0:
+                        raise subprocess.CalledProcessError(proc.returncode, item.cmd, stdout)
+                    result = stdout.decode()
+            except subprocess.CalledProcessError as e:
+                if item.stream:
+                    e.output = ''.join(output)
+                else:
+                    e.output = e.output.decode()
+                error = e
+    finally:
+        steps.close()
+
+
+class RemoteRefs:
+    """
+    Refs advertised by a remote repository, parsed from `git ls-remote --symref`
+
+    Attributes:
+        head (Optional[str]): Name of the branch the remote's HEAD points to
+        heads (dict): Maps branch names to the SHA they point to
+        tags (dict): Maps tag names to the SHA of the commit they point to
+    """
+    def __init__(self, head=None, heads=None, tags=None):
+        self.head = head
+        self.heads = heads or {}
+        self.tags = tags or {}
+
+    @classmethod
+    def parse(cls, output):
+        """
+        Parse the output of `git ls-remote --symref`
+        """
+        refs = cls()
+        for line in output.splitlines():
+            if line.startswith("ref:"):
+                # line resembles --> ref: refs/heads/main HEAD
+                _, ref, name = line.split()
+                if name == "HEAD" and ref.startswith("refs/heads/"):
+                    refs.head = ref[len("refs/heads/"):]
+                continue
+            sha, ref = line.split()
+            if ref.startswith("refs/heads/"):
+                refs.heads[ref[len("refs/heads/"):]] = sha
+            elif ref.startswith("refs/tags/"):
+                tag = ref[len("refs/tags/"):]
+                if tag.endswith("^{}"):
+                    # Annotated tags are listed twice, prefer the commit
+                    # they point to over the tag object itself
+                    refs.tags[tag[:-3]] = sha
+                else:
+                    refs.tags.setdefault(tag, sha)
+        return refs
+
+    def has_branch(self, name):
+        """
+        Return true if name is a branch or tag on the remote
+        """
+        return name in self.heads or name in self.tags
+
+    def sha(self, name):
+        """
+        Return the SHA that branch or tag name points to, or None
+        """
+        return self.heads.get(name, self.tags.get(name))
+
+    def to_dict(self):
+        return {"head": self.head, "heads": self.heads, "tags": self.tags}
+
+
 class GitPuller(Configurable):
     depth = Integer(
         config=True,
@@ -71,53 +467,251 @@ class GitPuller(Configurable):
         where the GitPuller class hadn't been loaded already."""
         return int(os.environ.get('NBGITPULLER_DEPTH', 1))
 
+    ref_cache_dir = Unicode(
+        config=True,
+        help="""
+        Directory to cache the refs advertised by remotes in, shared by all
+        nbgitpuller processes on the node. When many servers resolve the
+        branch of the same repository at once, only one of them asks the
+        remote. It must be writable by every user sharing it.
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_REF_CACHE_DIR. The cache is disabled if this is empty.
+        """
+    )
+
+    @default('ref_cache_dir')
+    def _ref_cache_dir_default(self):
+        return os.environ.get('NBGITPULLER_REF_CACHE_DIR', '')
+
+    ref_cache_ttl = Float(
+        30,
+        config=True,
+        help="""
+        Number of seconds the refs in ref_cache_dir are reused for before
+        asking the remote again.
+        """
+    )
+
+    reference_dir = Unicode(
+        config=True,
+        help="""
+        Directory of reference repositories shared by all nbgitpuller
+        processes on the node. Clones borrow the objects they need from a
+        full clone of the same remote kept here, so each repository is only
+        downloaded and stored once per node. The processes sharing it must
+        all run as the same user, reference repositories owned by other
+        users aren't used.
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_REFERENCE_DIR. Reference repositories aren't used if this
+        is empty.
+        """
+    )
+
+    @default('reference_dir')
+    def _reference_dir_default(self):
+        return os.environ.get('NBGITPULLER_REFERENCE_DIR', '')
+
+    reference_dissociate = Bool(
+        False,
+        config=True,
+        help="""
+        Copy the objects borrowed from the reference repository into new
+        clones, so they keep working if reference_dir is removed. Downloads
+        are still shared, but disk space isn't.
+        """
+    )
+
+    sparse_checkout = Bool(
+        config=True,
+        help="""
+        Only check out the directory a link points to (its subPath), using a
+        partial clone and a cone mode sparse checkout. Files elsewhere in the
+        repository are only downloaded once a link points to them. Links
+        without a subPath check out the whole repository. Requires git 2.27
+        or later, older versions always check out the whole repository.
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_SPARSE_CHECKOUT, or False if the environment variable
+        isn't set.
+        """
+    )
+
+    @default('sparse_checkout')
+    def _sparse_checkout_default(self):
+        return os.environ.get('NBGITPULLER_SPARSE_CHECKOUT', '').lower() in ('1', 'true', 'yes')
+
+    lazy_blob_limit = Unicode(
+        config=True,
+        help="""
+        Don't download files larger than this (e.g. "1m") when cloning. They
+        are replaced by small placeholders, and downloaded the first time they
+        are opened in Jupyter. Files that change upstream are downloaded when
+        they are pulled. Not used together with sparse_checkout.
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_LAZY_BLOB_LIMIT. Every file is downloaded if this is
+        empty.
+        """
+    )
+
+    @default('lazy_blob_limit')
+    def _lazy_blob_limit_default(self):
+        return os.environ.get('NBGITPULLER_LAZY_BLOB_LIMIT', '')
+
+    mirror_dir = Unicode(
+        config=True,
+        help="""
+        Directory of mirrors kept up to date by `gitpuller-mirror`. Remotes
+        that have a mirror there are fetched from the mirror instead, while
+        origin still points to the remote in clones.
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_MIRROR_DIR. Mirrors aren't used if this is empty.
+        """
+    )
+
+    @default('mirror_dir')
+    def _mirror_dir_default(self):
+        return os.environ.get('NBGITPULLER_MIRROR_DIR', '')
+
+    merge_engine = Enum(
+        ['merge', 'merge-tree'],
+        config=True,
+        help="""
+        How local changes are merged with the remote branch. "merge" commits
+        them and runs `git merge`. "merge-tree" works out the result with
+        `git merge-tree` first, without touching the index or working tree,
+        and then updates only the files that changed in one step. It needs
+        git 2.38 or later, and falls back to "merge" for conflicts it can't
+        resolve the same way (any conflict within a file before git 2.40).
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_MERGE_ENGINE, or "merge" if the environment variable
+        isn't set.
+        """
+    )
+
+    @default('merge_engine')
+    def _merge_engine_default(self):
+        return os.environ.get('NBGITPULLER_MERGE_ENGINE', 'merge')
+
+    git_backend = Enum(
+        ['cli', 'dulwich'],
+        config=True,
+        help="""
+        How questions about the state of the clone, such as whether it is up
+        to date or has local changes, are answered. "cli" runs git for each
+        of them. "dulwich" answers them without starting a process, using
+        the optional dulwich package, and falls back to "cli" if it isn't
+        installed. Changes to the clone are always made with git.
+
+        Defaults to the value of the environment variable
+        NBGITPULLER_GIT_BACKEND, or "cli" if the environment variable isn't
+        set.
+        """
+    )
+
+    @default('git_backend')
+    def _git_backend_default(self):
+        return os.environ.get('NBGITPULLER_GIT_BACKEND', 'cli')
+
     def __init__(self, git_url, repo_dir, **kwargs):
         assert git_url
 
         self.git_url = git_url
         self.branch_name = kwargs.pop("branch", None)
+        self.subpath = normalize_subpath(kwargs.pop("subpath", None))
         self.repo_dir = repo_dir
+        self.remote_refs = None
+        # How the last pull went: 'clone', 'up-to-date', 'fast-forward' or 'merge'
+        self.pull_type = None
+        # Directories of the sparse checkout in repo_dir, None if everything
+        # is checked out
+        self.sparse_dirs = None
+        # ChangeSet from HEAD to the remote branch, computed once per update
+        self.upstream_changes = None
+        # Passed in to keep the time spent resolving the branch if that fails
+        self.timings = kwargs.pop("timings", None) or Timings()
         backup = kwargs.pop("backup", False)
 
-        if self.branch_name is None:
-            self.branch_name = self.resolve_default_branch()
-        else:
-            self.branch_exists(self.branch_name)
+        newargs = {k: v for k, v in kwargs.items() if v is not None}
+        super(GitPuller, self).__init__(**newargs)
+        self.backend = get_backend(self.git_backend)
+
+        # If the repo has already been cloned, the fetch in update() is the
+        # only network round trip we need, so work out the branch from the
+        # local clone and only ask the remote when that isn't possible.
+        cloned = not backup and os.path.exists(os.path.join(self.repo_dir, '.git'))
+        with self.timings.blocking('resolve-branch'):
+            if self.branch_name is None:
+                if cloned:
+                    self.branch_name = self.resolve_local_default_branch()
+                if self.branch_name is None:
+                    self.branch_name = self.resolve_default_branch()
+            elif not (cloned and self.local_branch_exists(self.branch_name)):
+                self.branch_exists(self.branch_name)
 
         if backup and os.path.exists(self.repo_dir):
             self.backup_repo_dir()
 
-        newargs = {k: v for k, v in kwargs.items() if v is not None}
-        super(GitPuller, self).__init__(**newargs)
+    def git_remote_cmd(self, *args):
+        """
+        Return the git command line for args, for commands that talk to the
+        remote. If the remote has a mirror in mirror_dir, git is told to use
+        the mirror instead.
+        """
+        cmd = ['git']
+        if self.mirror_dir:
+            path = mirror_path(self.mirror_dir, self.git_url)
+            if os.path.exists(path):
+                # Rewriting the URL on the command line leaves the remote's
+                # URL in the clone's config untouched
+                cmd.extend(['-c', 'url.file://{}.insteadOf={}'.format(path, self.git_url)])
+        cmd.extend(args)
+        return cmd
+
+    def ls_remote(self, refresh=False, cached=True):
+        """
+        List the refs of the remote in a single round trip
+
+        The parsed RemoteRefs are kept as self.remote_refs, so the rest of
+        the pull can reuse them without asking the remote again. If
+        ref_cache_dir is set, recent results from other processes on the node
+        are used instead of asking the remote, unless refresh is true. If
+        cached is false, the remote is asked and the cache left alone.
+        """
+        def fetch():
+            result = subprocess.run(
+                self.git_remote_cmd(
+                    "ls-remote", "--symref", "--", self.git_url,
+                    "HEAD", "refs/heads/*", "refs/tags/*",
+                ),
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            return RemoteRefs.parse(result.stdout).to_dict()
 
+        if self.ref_cache_dir and cached:
+            refs = RefCache(self.ref_cache_dir, self.ref_cache_ttl).get(self.git_url, fetch, refresh)
+        else:
+            refs = fetch()
+        self.remote_refs = RemoteRefs(**refs)
+        return self.remote_refs
 
     def branch_exists(self, branch):
         """
         This checks to make sure the branch we are told to access
         exists in the repo
         """
-        heads = subprocess.run(
-            ["git", "ls-remote", "--heads", "--", self.git_url],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        tags = subprocess.run(
-            ["git", "ls-remote", "--tags", "--", self.git_url],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        lines = heads.stdout.splitlines() + tags.stdout.splitlines()
-        branches = []
-        for line in lines:
-            _, ref = line.split()
-            refs, heads, branch_name = ref.split("/", 2)
-            branches.append(branch_name)
-        if branch in branches:
+        if self.ls_remote().has_branch(branch):
             return
-        else:
-            raise BranchExistError()
+        # The branch may have been pushed since the cached refs were listed
+        if self.ref_cache_dir and self.ls_remote(refresh=True).has_branch(branch):
+            return
+        raise BranchExistError()
 
 
     def resolve_default_branch(self):
@@ -126,23 +720,52 @@ class GitPuller(Configurable):
         the case where the branch given does not exist
         """
         try:
-            head_branch = subprocess.run(
-                ["git", "ls-remote", "--symref", "--", self.git_url, "HEAD"],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            for line in head_branch.stdout.splitlines():
-                if line.startswith("ref:"):
-                    # line resembles --> ref: refs/heads/main HEAD
-                    _, ref, head = line.split()
-                    refs, heads, branch_name = ref.split("/", 2)
-                    return branch_name
-            raise BranchResolveError()
+            remote_refs = self.ls_remote()
         except subprocess.CalledProcessError:
             error = BranchResolveError()
             logging.exception(error)
             raise error
+        if not remote_refs.head and self.ref_cache_dir:
+            remote_refs = self.ls_remote(refresh=True)
+        if remote_refs.head:
+            return remote_refs.head
+        raise BranchResolveError()
+
+    def resolve_local_default_branch(self):
+        """
+        Resolve the default branch from the existing clone, without asking the
+        remote. Returns None if it can't be determined locally.
+        """
+        for cmd in [
+            # Recorded by `git clone` as the remote's default branch
+            ['git', 'symbolic-ref', '--quiet', 'refs/remotes/origin/HEAD'],
+            # The branch we have been merging from so far
+            ['git', 'rev-parse', '--symbolic-full-name', '@{upstream}'],
+        ]:
+            try:
+                ref = subprocess.check_output(
+                    cmd, cwd=self.repo_dir, stderr=subprocess.DEVNULL
+                ).decode().strip()
+            except subprocess.CalledProcessError:
+                continue
+            if ref.startswith('refs/remotes/origin/'):
+                return ref[len('refs/remotes/origin/'):]
+        return None
+
+    def local_branch_exists(self, branch):
+        """
+        Return true if the existing clone already knows branch as a remote
+        tracking branch or a tag
+        """
+        candidates = ['refs/remotes/origin/{}'.format(branch), 'refs/tags/{}'.format(branch)]
+        try:
+            refs = subprocess.check_output(
+                ['git', 'for-each-ref', '--format=%(refname)'] + candidates,
+                cwd=self.repo_dir, stderr=subprocess.DEVNULL
+            ).decode().splitlines()
+        except subprocess.CalledProcessError:
+            return False
+        return any(ref in candidates for ref in refs)
 
     def backup_repo_dir(self):
         """
@@ -166,8 +789,24 @@ class GitPuller(Configurable):
         Pull selected repo from a remote git repository,
         while preserving user changes
         """
+        yield from run_steps(self.pull_steps())
+
+    async def pull_async(self):
+        """
+        Like pull, but runs git asynchronously on the current asyncio event
+        loop instead of blocking
+        """
+        async for line in run_steps_async(self.pull_steps()):
+            yield line
+
+    def pull_steps(self):
+        """
+        The steps of a pull. Like the other step methods below, this yields
+        output lines and GitCommands to be run by run_steps or run_steps_async.
+        The time each phase takes is recorded in self.timings.
+        """
         if not os.path.exists(self.repo_dir):
-            yield from self.initialize_repo()
+            yield from self.timings.timed('clone', self.initialize_repo())
         else:
             yield from self.update()
 
@@ -176,14 +815,222 @@ class GitPuller(Configurable):
         Clones repository
         """
         logging.info('Repo {} doesn\'t exist. Cloning...'.format(self.repo_dir))
-        clone_args = ['git', 'clone']
+        self.pull_type = 'clone'
+        # --progress makes git report its progress even though its output
+        # isn't a terminal, for the status page to show
+        clone_args = self.git_remote_cmd('clone', '--progress')
         if self.depth and self.depth > 0:
             clone_args.extend(['--depth', str(self.depth)])
+        if self.reference_dir:
+            reference = yield from self.update_reference()
+            if reference:
+                clone_args.extend(['--reference-if-able', reference])
+                if self.reference_dissociate:
+                    clone_args.append('--dissociate')
+        sparse = self.sparse_checkout and self.subpath and git_version() >= (2, 27)
+        lazy = self.lazy_blob_limit and not sparse
+        if sparse:
+            # Only download the blobs of the files that are checked out
+            clone_args.extend(['--filter=blob:none', '--sparse'])
+        elif lazy:
+            clone_args.extend(['--filter=blob:limit={}'.format(self.lazy_blob_limit), '--no-checkout'])
         clone_args.extend(['--branch', self.branch_name])
         clone_args.extend(["--", self.git_url, self.repo_dir])
-        yield from execute_cmd(clone_args)
+        yield GitCommand(clone_args)
+        if sparse:
+            yield GitCommand(['git', 'sparse-checkout', 'init', '--cone'], cwd=self.repo_dir)
+            sparse_dir = yield from self.find_sparse_dir('HEAD')
+            if sparse_dir:
+                yield GitCommand(['git', 'sparse-checkout', 'set', sparse_dir], cwd=self.repo_dir)
+        elif lazy:
+            yield from self.checkout_lazily()
         logging.info('Repo {} initialized'.format(self.repo_dir))
 
+    def update_reference(self):
+        """
+        Bring the reference repository of git_url in reference_dir up to
+        date, creating it if needed, and return its path.
+
+        If another process on the node is already updating it, it is used as
+        it is. Problems with the reference repository aren't fatal, the clone
+        then fetches everything from the remote. Returns None if there is no
+        reference repository to use.
+        """
+        os.makedirs(self.reference_dir, exist_ok=True)
+        path = os.path.join(self.reference_dir, url_key(self.git_url) + '.git')
+        if os.path.exists(path) and os.stat(path).st_uid != os.getuid():
+            # git would run hooks and read config planted by its owner
+            logging.warning('Not using reference repository {} owned by another user'.format(path))
+            return None
+        try:
+            with file_lock(path + '.lock', blocking=False):
+                if not os.path.exists(path):
+                    yield from self.create_reference(path)
+                elif not (yield from self.reference_has_branch(path)):
+                    yield 'Updating the shared copy of {}\n'.format(self.git_url)
+                    yield GitCommand(self.git_remote_cmd('fetch', 'origin'), cwd=path)
+        except BlockingIOError:
+            logging.info('Reference repository {} is being updated, using it as it is'.format(path))
+        except (OSError, subprocess.CalledProcessError):
+            logging.exception('Could not update reference repository {}'.format(path))
+        return path if os.path.exists(path) else None
+
+    def create_reference(self, path):
+        """
+        Make a full clone of git_url at path, to be used as a reference
+        repository
+        """
+        yield 'Making a shared copy of {}\n'.format(self.git_url)
+        # Clone next to path and move it in place once complete, so other
+        # processes never borrow from a partial clone
+        tmp_path = tempfile.mkdtemp(dir=self.reference_dir, prefix='.tmp-')
+        try:
+            yield GitCommand(self.git_remote_cmd(
+                'clone', '--bare',
+                # Clones borrow objects without the reference knowing about
+                # it, so they must never be removed
+                '--config', 'gc.auto=0',
+                '--config', 'gc.pruneExpire=never',
+                '--', self.git_url, tmp_path
+            ))
+            # Bare clones don't fetch anything by default
+            yield GitCommand(
+                ['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*'],
+                cwd=tmp_path, stream=False
+            )
+            os.chmod(tmp_path, 0o755)
+            os.rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def reference_has_branch(self, path):
+        """
+        Return true if the reference repository at path already has the
+        commit the remote branch points to
+        """
+        sha = self.remote_refs and self.remote_refs.sha(self.branch_name)
+        if not sha:
+            return False
+        try:
+            yield GitCommand(['git', 'cat-file', '-e', sha + '^{commit}'], cwd=path, stream=False)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def checkout_lazily(self):
+        """
+        Check out a clone made without the large blobs, writing placeholders
+        for the files whose blob is missing
+        """
+        yield GitCommand(['git', 'read-tree', 'HEAD'], cwd=self.repo_dir, stream=False)
+        output = yield GitCommand(
+            ['git', 'rev-list', '--objects', '--missing=print', 'HEAD'], cwd=self.repo_dir, stream=False
+        )
+        missing = {line[1:] for line in output.splitlines() if line.startswith('?')}
+        placeholders = {}
+        if missing:
+            output = yield GitCommand(['git', 'ls-tree', '-r', '-z', 'HEAD'], cwd=self.repo_dir, stream=False)
+            for entry in output.split('\0'):
+                if not entry:
+                    continue
+                # Entries are `<mode> <type> <object>\t<path>`
+                info, path = entry.split('\t', 1)
+                sha = info.split(' ')[2]
+                if sha in missing:
+                    placeholders[path] = sha
+            # Have git ignore the placeholders
+            yield GitCommand(
+                ['git', 'update-index', '--skip-worktree', '-z', '--stdin'], cwd=self.repo_dir,
+                stream=False, input=''.join(path + '\0' for path in placeholders).encode()
+            )
+        yield GitCommand(['git', 'checkout-index', '--all', '-u'], cwd=self.repo_dir)
+        for path, sha in placeholders.items():
+            write_placeholder(os.path.join(self.repo_dir, path), sha)
+        if placeholders:
+            yield '{} large files will be downloaded when they are opened\n'.format(len(placeholders))
+
+    def find_skipped_files(self):
+        """
+        Return the files git ignores because they may be placeholders
+        """
+        if not (yield Call(self.backend.get_config, self.repo_dir, 'remote.origin.partialclonefilter')):
+            # Not a partial clone, so there are no placeholders
+            return []
+        output = yield GitCommand(['git', 'ls-files', '-v', '-z'], cwd=self.repo_dir, stream=False)
+        return [entry[2:] for entry in output.split('\0') if entry.startswith('S ')]
+
+    def drop_changed_placeholders(self, skipped):
+        """
+        Remove the placeholders of files changed upstream, so the merge can
+        write the new version in their place
+        """
+        placeholders = {path for path in skipped if is_placeholder(os.path.join(self.repo_dir, path))}
+        if not placeholders:
+            return
+        changes = yield from self.find_upstream_changes()
+        for path in placeholders & changes.paths():
+            os.remove(os.path.join(self.repo_dir, path))
+
+    def track_downloaded_files(self, skipped):
+        """
+        Stop ignoring files that are no longer placeholders, after a merge
+        wrote the upstream version of them
+        """
+        downloaded = [
+            path for path in skipped
+            if os.path.lexists(os.path.join(self.repo_dir, path))
+            and not is_placeholder(os.path.join(self.repo_dir, path))
+        ]
+        if downloaded:
+            yield GitCommand(
+                ['git', 'update-index', '--no-skip-worktree', '-z', '--stdin'], cwd=self.repo_dir,
+                stream=False, input=''.join(path + '\0' for path in downloaded).encode()
+            )
+
+    def find_sparse_dir(self, commit):
+        """
+        Return the directory to check out for subpath, which may be a file
+        in commit
+        """
+        output = yield GitCommand(
+            ['git', 'ls-tree', commit, '--', self.subpath], cwd=self.repo_dir, stream=False
+        )
+        # Output is `<mode> <type> <object>\t<path>`
+        if output.split(' ', 2)[1:2] == ['blob']:
+            return posixpath.dirname(self.subpath)
+        return self.subpath
+
+    def find_sparse_dirs(self):
+        """
+        Return the directories of the cone mode sparse checkout in repo_dir,
+        or None if it isn't a sparse checkout
+        """
+        for name in ['core.sparseCheckout', 'core.sparseCheckoutCone']:
+            value = yield Call(self.backend.get_config, self.repo_dir, name)
+            if (value or '').lower() != 'true':
+                # Most clones aren't sparse, and stop at the first check
+                return None
+        output = yield GitCommand(['git', 'sparse-checkout', 'list'], cwd=self.repo_dir, stream=False)
+        return [line for line in output.splitlines() if line]
+
+    def widen_sparse_checkout(self):
+        """
+        Make sure a sparse checkout in repo_dir includes subpath, checking out
+        everything if there's no subpath
+        """
+        self.sparse_dirs = yield from self.find_sparse_dirs()
+        if self.sparse_dirs is None:
+            return
+        if not self.subpath:
+            yield GitCommand(['git', 'sparse-checkout', 'disable'], cwd=self.repo_dir)
+            self.sparse_dirs = None
+            return
+        sparse_dir = yield from self.find_sparse_dir('origin/{}'.format(self.branch_name))
+        if sparse_dir and not any(sparse_dir == d or sparse_dir.startswith(d + '/') for d in self.sparse_dirs):
+            yield GitCommand(['git', 'sparse-checkout', 'add', sparse_dir], cwd=self.repo_dir)
+            self.sparse_dirs.append(sparse_dir)
+
     def reset_deleted_files(self):
         """
         Runs the equivalent of git checkout -- <file> for each file that was
@@ -192,57 +1039,111 @@ class GitPuller(Configurable):
         """
 
         yield from self.ensure_lock()
-        deleted_files = subprocess.check_output([
-            'git', 'ls-files', '--deleted', '-z'
-        ], cwd=self.repo_dir).decode().strip().split('\0')
-
-        upstream_deleted = self.find_upstream_changed('D')
+        deleted_files = yield Call(self.backend.deleted_files, self.repo_dir)
+        if not deleted_files:
+            return
+        upstream_deleted = (yield from self.find_upstream_changes()).paths('D')
+        # Files deleted in _both_ are checked out from HEAD, even though they
+        # are just about to be deleted, to avoid a conflict with git 2.40.
+        # The others are restored from upstream.
+        upstream = 'origin/{}'.format(self.branch_name)
+        sources = {'HEAD': [], upstream: []}
         for filename in deleted_files:
-            if not filename:
-                # filter out empty lines
-                continue
+            sources['HEAD' if filename in upstream_deleted else upstream].append(filename)
 
-            if filename in upstream_deleted:
-                # deleted in _both_, avoid conflict with git 2.40 by checking it out
-                # even though it's just about to be deleted
-                yield from execute_cmd(
-                    ['git', 'checkout', 'HEAD', '--', filename], cwd=self.repo_dir
+        # Restore as many files as fit on a command line at once, rather
+        # than running git for each of them
+        for source, filenames in sources.items():
+            if not filenames:
+                continue
+            yield 'Restoring {} deleted files from {}\n'.format(len(filenames), source)
+            for chunk in chunk_paths(filenames):
+                yield GitCommand(
+                    ['git', '--literal-pathspecs', 'checkout', source, '--'] + chunk,
+                    cwd=self.repo_dir, stream=False
                 )
-            else:
-                # not deleted in upstream, restore with checkout
-                yield from execute_cmd(['git', 'checkout', 'origin/{}'.format(self.branch_name), '--', filename], cwd=self.repo_dir)
 
-    def repo_is_dirty(self):
+    def is_up_to_date(self):
         """
-        Return true if repo is dirty
+        Return true if HEAD already has the latest commit of the remote
+        branch, asking the remote instead of fetching from it, never the ref
+        cache
         """
         try:
-            subprocess.check_call(['git', 'diff-files', '--quiet'], cwd=self.repo_dir)
-            # Return code is 0
-            return False
+            # Cached refs could be older than the latest push
+            remote_refs = yield Call(self.ls_remote, cached=False)
         except subprocess.CalledProcessError:
-            return True
+            # Leave reporting the problem to the fetch
+            return False
+        sha = remote_refs.sha(self.branch_name)
+        if not sha:
+            return False
+        # False if we don't have the commit, or HEAD doesn't include it
+        return (yield Call(self.backend.is_ancestor, self.repo_dir, sha, 'HEAD'))
+
+    def can_fast_forward(self):
+        """
+        Return true if there are no local commits or changes to tracked
+        files, so the remote branch can be checked out as it is
+        """
+        upstream = 'origin/{}'.format(self.branch_name)
+        return (
+            (yield Call(self.backend.is_ancestor, self.repo_dir, 'HEAD', upstream))
+            and not (yield Call(self.backend.has_unstaged_changes, self.repo_dir))
+            and not (yield Call(self.backend.has_staged_changes, self.repo_dir))
+        )
+
+    def fast_forward(self):
+        """
+        Move the clean working tree to the remote branch, only touching the
+        files that changed
+        """
+        yield 'Fast-forwarding to origin/{}\n'.format(self.branch_name)
+        # Untracked files are the only local changes that can be in the way
+        yield from self.rename_local_untracked()
+        skipped = yield from self.find_skipped_files()
+        yield from self.drop_changed_placeholders(skipped)
+        yield from self.ensure_lock()
+        yield GitCommand(
+            ['git', 'merge', '--ff-only', 'origin/{}'.format(self.branch_name)], cwd=self.repo_dir
+        )
+        yield from self.track_downloaded_files(skipped)
+
+    def repo_is_dirty(self):
+        """
+        Return true if repo is dirty
+        """
+        return (yield Call(self.backend.has_unstaged_changes, self.repo_dir))
 
     def update_remotes(self):
         """
         Do a git fetch so our remotes are up to date
         """
-        yield from execute_cmd(['git', 'fetch'], cwd=self.repo_dir)
+        yield GitCommand(self.git_remote_cmd('fetch', '--progress'), cwd=self.repo_dir)
+
+    def find_upstream_changes(self):
+        """
+        Return the ChangeSet from HEAD to the remote branch
+
+        It is computed once per update, and shared by the steps that need it.
+        Files outside a sparse checkout are left out, since they are never
+        written.
+        """
+        if self.upstream_changes is None:
+            changes = yield Call(
+                self.backend.diff, self.repo_dir, 'HEAD', 'origin/{}'.format(self.branch_name)
+            )
+            if self.sparse_dirs is not None:
+                changes = changes.filter(lambda path: in_sparse_cone(path, self.sparse_dirs))
+            self.upstream_changes = changes
+        return self.upstream_changes
 
     def find_upstream_changed(self, kind):
         """
         Return list of files that have been changed upstream belonging to a particular kind of change
         """
-        output = subprocess.check_output([
-            'git', 'diff', '..origin/{}'.format(self.branch_name),
-            '--name-status'
-        ], cwd=self.repo_dir).decode()
-        files = []
-        for line in output.split('\n'):
-            if line.startswith(kind):
-                files.append(line.split('\t', 1)[1])
-
-        return files
+        changes = self.backend.diff(self.repo_dir, 'HEAD', 'origin/{}'.format(self.branch_name))
+        return sorted(changes.paths(kind))
 
     def ensure_lock(self):
         """
@@ -273,8 +1174,8 @@ class GitPuller(Configurable):
         Rename local untracked files that would require pulls
         """
         # Find what files have been added!
-        new_upstream_files = self.find_upstream_changed('A')
-        for f in new_upstream_files:
+        new_upstream_files = (yield from self.find_upstream_changes()).paths('A')
+        for f in sorted(new_upstream_files):
             f = os.path.join(self.repo_dir, f)
             if os.path.exists(f):
                 # If there's a file extension, put the timestamp before that
@@ -296,23 +1197,26 @@ class GitPuller(Configurable):
         - Detect (modify/delete) conflicts, where the user has locally modified something
           that was deleted upstream. We just keep the local file.
         """
-        modify_delete_conflict = False
         try:
-            for line in execute_cmd([
+            output = yield GitCommand([
                 'git',
                 '-c', 'user.email=nbgitpuller@nbgitpuller.link',
                 '-c', 'user.name=nbgitpuller',
                 'merge',
                 '-Xours', 'origin/{}'.format(self.branch_name)
             ],
-            cwd=self.repo_dir):
-                yield line
-                # Detect conflict caused by one branch
-                if line.startswith("CONFLICT (modify/delete)"):
-                    modify_delete_conflict = True
-        except subprocess.CalledProcessError:
-            if not modify_delete_conflict:
-                raise
+            cwd=self.repo_dir)
+            error = None
+        except subprocess.CalledProcessError as e:
+            output = e.output
+            error = e
+
+        # Detect conflict caused by one branch
+        modify_delete_conflict = any(
+            line.startswith("CONFLICT (modify/delete)") for line in output.splitlines()
+        )
+        if error and not modify_delete_conflict:
+            raise error
 
         if modify_delete_conflict:
             yield "Caught modify/delete conflict, trying to resolve"
@@ -320,11 +1224,118 @@ class GitPuller(Configurable):
             # we just keep the modified file.  This is done by `git add`ing it.
             yield from self.commit_all()
 
+    def merge_tree(self):
+        """
+        Merges branch from origin into current branch like merge, but works
+        out the result before touching the working tree.
+
+        Local changes are committed without checking the commit out, and
+        `git merge-tree` merges it with the remote branch. Only then is the
+        working tree updated, writing just the files that differ from HEAD.
+        Returns false without having changed anything if the merge can't be
+        done the way merge would do it, so merge can be used instead.
+        """
+        upstream = 'origin/{}'.format(self.branch_name)
+        identity = ['-c', 'user.email=nbgitpuller@nbgitpuller.link', '-c', 'user.name=nbgitpuller']
+
+        # merge unstages new files, leaving them out of the automatic commit
+        added = yield GitCommand(
+            ['git', 'diff-index', '--cached', '--name-only', '--diff-filter=A', 'HEAD'],
+            cwd=self.repo_dir, stream=False
+        )
+        if added:
+            return False
+
+        # A commit of the tracked files as they are in the working tree
+        stash = (yield GitCommand(['git'] + identity + ['stash', 'create'], cwd=self.repo_dir, stream=False)).strip()
+        if stash:
+            local = (yield GitCommand(
+                ['git'] + identity + [
+                    'commit-tree', stash + '^{tree}', '-p', 'HEAD', '-m', 'Automatic commit by nbgitpuller'
+                ],
+                cwd=self.repo_dir, stream=False
+            )).strip()
+        else:
+            local = 'HEAD'
+
+        cmd = ['git'] + identity + ['merge-tree', '--write-tree', '-z']
+        if git_version() >= (2, 40):
+            # Older versions can't resolve conflicts within files
+            cmd.append('-Xours')
+        try:
+            output = yield GitCommand(cmd + [local, upstream], cwd=self.repo_dir, stream=False)
+        except subprocess.CalledProcessError as e:
+            # Exits with 1 if there were conflicts
+            if e.returncode != 1:
+                raise
+            output = e.output
+        tree, conflicts = parse_merge_tree(output)
+        # Only modify/delete conflicts are resolved like merge resolves them:
+        # the modified file is kept, and merge-tree has left it in the tree
+        if any(stages not in ({1, 2}, {1, 3}) for stages in conflicts.values()):
+            yield 'Conflicts found, merging with git merge instead\n'
+            return False
+        if conflicts:
+            yield 'Caught modify/delete conflict, keeping the modified files\n'
+            message = 'Automatic commit by nbgitpuller'
+        else:
+            message = "Merge remote-tracking branch '{}'".format(upstream)
+        merged = (yield GitCommand(
+            ['git'] + identity + ['commit-tree', tree, '-p', local, '-p', upstream, '-m', message],
+            cwd=self.repo_dir, stream=False
+        )).strip()
+
+        # read-tree overwrites untracked and ignored files in the way of the
+        # files it writes, where merge refuses to
+        if (yield from self.untracked_in_the_way(merged)):
+            yield 'Untracked files in the way, merging with git merge instead\n'
+            return False
+
+        # Files changed upstream replace their placeholders, if this is a
+        # clone with placeholders (see lazy_blob_limit)
+        skipped = yield from self.find_skipped_files()
+        yield from self.drop_changed_placeholders(skipped)
+
+        # The merged tree has every local change in it, so only files that
+        # differ between HEAD and it need writing
+        yield from self.ensure_lock()
+        yield GitCommand(['git', 'read-tree', '--reset', '-u', 'HEAD', merged], cwd=self.repo_dir)
+        yield GitCommand(
+            ['git', 'update-ref', '-m', 'nbgitpuller: merge {}'.format(upstream), 'HEAD', merged],
+            cwd=self.repo_dir
+        )
+        yield from self.track_downloaded_files(skipped)
+        return True
+
+    def untracked_in_the_way(self, tree):
+        """
+        Return true if checking out tree over HEAD would overwrite untracked
+        or ignored files: ones at the path of a file tree adds, at one of its
+        parent directories, or inside a directory that becomes a file.
+        """
+        added = (yield Call(self.backend.diff, self.repo_dir, 'HEAD', tree)).paths('A')
+        if not added:
+            return False
+        # Untracked directories are listed once, as `dir/`
+        output = yield GitCommand(
+            ['git', 'ls-files', '--others', '--directory', '-z'], cwd=self.repo_dir, stream=False
+        )
+        untracked = {path.rstrip('/') for path in output.split('\0') if path}
+        untracked_parents = {
+            path.rsplit('/', n)[0] for path in untracked for n in range(1, path.count('/') + 1)
+        }
+        for path in added:
+            if path in untracked or path in untracked_parents:
+                return True
+            if any(path.rsplit('/', n)[0] in untracked for n in range(1, path.count('/') + 1)):
+                return True
+        return False
+
     def commit_all(self):
         """
         Creates a new commit with all current changes
         """
-        yield from execute_cmd([
+        yield GitCommand([
             'git',
             # We explicitly set user info of the commits we are making, to keep that separate from
             # whatever author info is set in system / repo config by the user. We pass '-c' to git
@@ -341,35 +1352,77 @@ class GitPuller(Configurable):
             '--allow-empty'
         ], cwd=self.repo_dir)
 
+    def commit_local_changes(self):
+        """
+        Commit the changes the user made to tracked files, if any
+        """
+        # Unstage any changes, otherwise the merge might fail.
+        # The following command resets the index, but keeps the working tree.  All changes
+        # to files will be preserved, but they are no longer staged for commit.
+        yield GitCommand(['git', 'reset', '--mixed'], cwd=self.repo_dir)
+
+        # If there are local changes, make a commit so we can do merges when pulling
+        if (yield from self.repo_is_dirty()):
+            yield from self.ensure_lock()
+            yield from self.commit_all()
+
+    def merge_upstream(self):
+        """
+        Merge the remote branch into the committed local changes
+        """
+        # Files changed upstream replace their placeholders, if this is a
+        # clone with placeholders (see lazy_blob_limit)
+        skipped = yield from self.find_skipped_files()
+        yield from self.drop_changed_placeholders(skipped)
+
+        # Merge master into local!
+        yield from self.ensure_lock()
+        yield from self.merge()
+
+        yield from self.track_downloaded_files(skipped)
+
     def update(self):
         """
         Do the pulling if necessary
         """
+        timed = self.timings.timed
+        self.upstream_changes = None
+        if (yield from timed('ls-remote', self.is_up_to_date())):
+            # Most repeated clicks on a link end here, with nothing to merge
+            self.pull_type = 'up-to-date'
+            yield 'Already up to date with {}\n'.format(self.branch_name)
+            yield from timed('sparse-checkout', self.widen_sparse_checkout())
+            yield from timed('reset', self.reset_deleted_files())
+            return
+        self.pull_type = 'merge'
+
         # Fetch remotes, so we know we're dealing with latest remote
-        yield from self.update_remotes()
+        yield from timed('fetch', self.update_remotes())
+
+        # Check out the directory the link points to, if this is a sparse
+        # checkout that doesn't include it yet
+        yield from timed('sparse-checkout', self.widen_sparse_checkout())
+
+        if (yield from timed('status', self.can_fast_forward())):
+            self.pull_type = 'fast-forward'
+            yield from timed('fast-forward', self.fast_forward())
+            return
 
         # Rename local untracked files that might be overwritten by pull
-        yield from self.rename_local_untracked()
+        yield from timed('rename', self.rename_local_untracked())
 
         # Reset local files that have been deleted. We don't actually expect users to
         # delete something that's present upstream and expect to keep it. This prevents
         # unnecessary conflicts, and also allows users to click the link again to get
         # a fresh copy of a file they might have screwed up.
-        yield from self.reset_deleted_files()
-
-        # Unstage any changes, otherwise the merge might fail.
-        # The following command resets the index, but keeps the working tree.  All changes
-        # to files will be preserved, but they are no longer staged for commit.
-        yield from execute_cmd(['git', 'reset', '--mixed'], cwd=self.repo_dir)
+        yield from timed('reset', self.reset_deleted_files())
 
-        # If there are local changes, make a commit so we can do merges when pulling
-        if self.repo_is_dirty():
-            yield from self.ensure_lock()
-            yield from self.commit_all()
+        if self.merge_engine == 'merge-tree' and git_version() >= (2, 38):
+            if (yield from timed('merge', self.merge_tree())):
+                return
 
-        # Merge master into local!
-        yield from self.ensure_lock()
-        yield from self.merge()
+        yield from timed('commit', self.commit_local_changes())
+        yield from timed('merge', self.merge_upstream())
 
 
 def main():
@@ -387,13 +1440,17 @@ def main():
     parser.add_argument('--backup', action='store_true', default=False, help='Whether to backup existing repo_dir if it exists')
     args = parser.parse_args()
 
-    for line in GitPuller(
+    gp = GitPuller(
         args.git_url,
         args.repo_dir,
         branch=args.branch_name if args.branch_name else None,
         backup=args.backup if args.backup else False,
-    ).pull():
-        print(line)
+    )
+    try:
+        for line in gp.pull():
+            print(line)
+    finally:
+        print(gp.timings.format())
 
 
 if __name__ == '__main__':
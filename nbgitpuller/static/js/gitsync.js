@@ -1,5 +1,5 @@
 export class GitSync {
-    constructor(baseUrl, repo, branch, depth, targetpath, path, backup, xsrf) {
+    constructor(baseUrl, repo, branch, depth, targetpath, path, backup, xsrf, subpath) {
         // Class that talks to the API backend & emits events as appropriate
         this.baseUrl = baseUrl;
         this.repo = repo;
@@ -9,6 +9,7 @@ export class GitSync {
         this.redirectUrl = baseUrl + path;
         this.backup = backup;
         this._xsrf = xsrf;
+        this.subpath = subpath;
 
         this.callbacks = {};
     }
@@ -44,6 +45,9 @@ export class GitSync {
         }
         if (typeof this.backup !== 'undefined' && this.backup != undefined) {
             syncUrlParams.append('backup', this.backup);
+        }
+        if (typeof this.subpath !== 'undefined' && this.subpath != undefined) {
+            syncUrlParams.append('subpath', this.subpath);
         }        
         const syncUrl = this.baseUrl + 'git-pull/api?' + syncUrlParams.toString();
 
@@ -5,6 +5,18 @@ import { WebLinksAddon } from 'xterm-addon-web-links';
 import { GitError } from './giterror';
 import DOMPurify from 'dompurify';
 
+// The part of the progress bar, in percent, taken up by each stage of a clone
+// or fetch that git reports the progress of
+const gitProgressStages = {
+    'Enumerating objects': [0, 2],
+    'Counting objects': [2, 5],
+    'Compressing objects': [5, 10],
+    'Receiving objects': [10, 80],
+    'Resolving deltas': [80, 90],
+    'Checking out files': [90, 100],
+    'Updating files': [90, 100],
+};
+
 export class GitSyncView{
     constructor(termSelector, progressSelector, termToggleSelector, containerErrorSelector, copyErrorSelector, containerErrorHelpSelector, recoveryLink) {
         // Class that encapsulates view rendering as much as possible
@@ -61,6 +73,28 @@ export class GitSyncView{
         return this.progress.querySelector('span').innerText;
     }
 
+    setGitProgress(progress) {
+        // Show the progress git reported, as parsed by nbgitpuller/progress.py
+        const range = gitProgressStages[progress.stage];
+        if (range && progress.percent !== null) {
+            const value = range[0] + (range[1] - range[0]) * progress.percent / 100;
+            // A fetch after a clone starts over, but the bar never goes back
+            this.setProgressValue(Math.max(this.getProgressValue(), value));
+        }
+        let text = progress.stage;
+        if (progress.percent !== null) {
+            text += `: ${progress.percent}% (${progress.current}/${progress.total})`;
+        } else {
+            text += `: ${progress.current}`;
+        }
+        if (progress.rate) {
+            text += `, ${progress.transferred} at ${progress.rate}`;
+        } else if (progress.transferred) {
+            text += `, ${progress.transferred}`;
+        }
+        this.setProgressText(text);
+    }
+
     setProgressError(isError) {
         if (isError) {
             this.progress.classList.add('progress-bar-danger');
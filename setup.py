@@ -30,7 +30,10 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     platforms='any',
-    install_requires=['jupyter_server>=1.10.1', 'tornado'],
+    install_requires=['jupyter_server>=1.10.1', 'prometheus_client', 'tornado'],
+    extras_require={
+        'dulwich': ['dulwich>=0.21'],
+    },
     data_files=[
         ('etc/jupyter/jupyter_server_config.d', ['nbgitpuller/etc/jupyter_server_config.d/nbgitpuller.json']),
         ('etc/jupyter/jupyter_notebook_config.d', ['nbgitpuller/etc/jupyter_notebook_config.d/nbgitpuller.json'])
@@ -39,6 +42,8 @@ setup(
     entry_points={
         'console_scripts': [
             'gitpuller = nbgitpuller.pull:main',
+            'gitpuller-mirror = nbgitpuller.mirror:main',
+            'gitpuller-bulk = nbgitpuller.bulk:main',
         ],
     },
     classifiers=[
@@ -1,6 +1,12 @@
+import asyncio
+import gzip
+import json
+import logging
 import os
 from http.client import HTTPConnection
+import shutil
 import subprocess
+import tempfile
 import time
 from urllib.parse import urlencode
 from uuid import uuid4
@@ -8,9 +14,13 @@ import notebook
 import pytest
 
 from repohelpers import Pusher, Remote
+from nbgitpuller.handlers import SyncOperation, coalesce, link_subpath
 
 PORT = os.getenv('TEST_PORT', 18888)
 
+# Directory holding a slow `git` wrapper, see the slow_git fixture
+SLOW_GIT_DIR = os.path.join(tempfile.gettempdir(), 'nbgitpuller-slow-git')
+
 
 def request_api(params, host='localhost'):
     query_args = {"token": "secret"}
@@ -21,6 +31,11 @@ def request_api(params, host='localhost'):
     h.request('GET', url)
     return h.getresponse()
 
+
+def parse_events(s):
+    return [json.loads(line[len('data: '):]) for line in s.splitlines() if line.startswith('data: ')]
+
+
 def wait_for_server(host='localhost', port=PORT, timeout=10):
     """Wait for an HTTP server to be responsive"""
     t = 0.1
@@ -48,6 +63,25 @@ def jupyterdir(tmpdir):
     return str(path)
 
 
+@pytest.fixture
+def slow_git():
+    """
+    Put a `git` in SLOW_GIT_DIR that takes a few seconds to list remote refs,
+    standing in for a slow or far-away git host
+    """
+    os.makedirs(SLOW_GIT_DIR, exist_ok=True)
+    script = os.path.join(SLOW_GIT_DIR, 'git')
+    with open(script, 'w') as f:
+        f.write(
+            '#!/bin/sh\n'
+            'case "$*" in *ls-remote*) sleep 3;; esac\n'
+            'exec {} "$@"\n'.format(shutil.which('git'))
+        )
+    os.chmod(script, 0o755)
+    yield
+    shutil.rmtree(SLOW_GIT_DIR)
+
+
 @pytest.fixture(params=["jupyter-server", "jupyter-notebook"])
 def jupyter_server(request, tmpdir, jupyterdir):
     # allow passing extra_env via @pytest.mark.jupyter_server(extra_env={"key": "value"})
@@ -119,7 +153,71 @@ def test_clone_default(jupyterdir, jupyter_server):
         target_path = os.path.join(jupyterdir, os.path.basename(remote.path))
         assert '--branch master' in s
         assert f"Cloning into '{target_path}" in s
+        assert '"pull_type": "clone"' in s
         assert os.path.isdir(os.path.join(target_path, '.git'))
+        finished = json.loads(s.strip().splitlines()[-1][len('data: '):])
+        assert finished['phase'] == 'finished'
+        assert set(finished['timings']) == {'resolve-branch', 'clone'}
+        assert 0 < finished['timings']['clone']['subprocess'] <= finished['timings']['clone']['wall']
+
+
+def test_branch_error_timings(jupyterdir, jupyter_server):
+    """
+    Tests that syncs of a missing branch report the time spent looking for it
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+        s = request_api({'repo': remote.path, 'branch': 'missing', 'targetpath': 'missing'}).read().decode()
+        print(s)
+        error = parse_events(s)[-1]
+        assert error['phase'] == 'error'
+        assert error['error']['code'] == 'branch_exist'
+        assert error['timings']['resolve-branch']['wall'] > 0
+
+
+@pytest.mark.jupyter_server(extra_env={
+    'PATH': SLOW_GIT_DIR + os.pathsep + os.environ['PATH'],
+    'NBGITPULLER_LOCK_TIMEOUT': '1',
+})
+def test_lock_timeout_timings(slow_git, jupyterdir, jupyter_server):
+    """
+    Tests that syncs giving up on a busy directory report how long they waited
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+        first = HTTPConnection('localhost', PORT, 20)
+        first.request('GET', '/git-pull/api?' + urlencode({'token': 'secret', 'repo': remote.path, 'branch': 'master'}))
+        time.sleep(0.5)
+        # Differs from the first, so it can't just follow it
+        second = request_api({'repo': remote.path})
+        s = second.read().decode()
+        print(s)
+        error = parse_events(s)[-1]
+        assert error['phase'] == 'error'
+        assert error['timings']['lock-wait']['wall'] >= 1
+        assert '"phase": "finished"' in first.getresponse().read().decode()
+
+
+def test_metrics(jupyterdir, jupyter_server):
+    """
+    Tests that syncs are counted in the server's Prometheus metrics
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+        for _ in range(2):
+            r = request_api({'repo': remote.path, 'branch': 'master'})
+            assert r.code == 200
+            r.read()
+
+        h = HTTPConnection('localhost', PORT, 10)
+        h.request('GET', '/metrics?token=secret')
+        r = h.getresponse()
+        assert r.code == 200
+        metrics = r.read().decode()
+        assert 'nbgitpuller_syncs_total{pull_type="clone"} 1.0' in metrics
+        assert 'nbgitpuller_syncs_total{pull_type="up-to-date"} 1.0' in metrics
+        assert 'nbgitpuller_sync_phase_duration_seconds_count{phase="clone"} 1.0' in metrics
+        assert 'nbgitpuller_lock_wait_seconds_count 2.0' in metrics
 
 
 def test_clone_auth(jupyterdir, jupyter_server):
@@ -197,3 +295,223 @@ def test_clone_backup(jupyterdir, jupyter_server):
         }
         r = request_api(params)
         assert r.code == 200
+
+
+@pytest.mark.jupyter_server(extra_env={'PATH': SLOW_GIT_DIR + os.pathsep + os.environ['PATH']})
+def test_slow_remote_does_not_block(slow_git, jupyterdir, jupyter_server):
+    """
+    Tests that the server keeps answering other requests while a sync waits
+    on a slow remote.
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+        query = urlencode({'token': 'secret', 'repo': remote.path, 'branch': 'master'})
+        sync = HTTPConnection('localhost', PORT, 10)
+        sync.request('GET', f'/git-pull/api?{query}')
+        # Give the sync time to start listing the remote's refs
+        time.sleep(1)
+
+        start = time.monotonic()
+        h = HTTPConnection('localhost', PORT, 10)
+        h.request('GET', '/api')
+        assert h.getresponse().code == 200
+        assert time.monotonic() - start < 1
+
+        s = sync.getresponse().read().decode()
+        print(s)
+        assert '"phase": "finished"' in s
+
+
+@pytest.mark.jupyter_server(extra_env={'PATH': SLOW_GIT_DIR + os.pathsep + os.environ['PATH']})
+def test_concurrent_syncs(slow_git, jupyterdir, jupyter_server):
+    """
+    Tests that syncs into different directories run at the same time, and that
+    a sync into a busy directory waits its turn instead of failing.
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+
+        def start_sync(target, branch='master'):
+            params = {'token': 'secret', 'repo': remote.path, 'targetpath': target}
+            if branch:
+                params['branch'] = branch
+            h = HTTPConnection('localhost', PORT, 20)
+            h.request('GET', f'/git-pull/api?{urlencode(params)}')
+            return h
+
+        start = time.monotonic()
+        first = start_sync('first')
+        # Make sure the first sync has taken the lock
+        time.sleep(1)
+        # The last request differs from the first, so it can't just follow it
+        syncs = [first, start_sync('second'), start_sync('first', branch=None)]
+
+        outputs = [h.getresponse().read().decode() for h in syncs[:2]]
+        # Listing the remote's refs takes 3s, the two clones were not serialized
+        assert time.monotonic() - start < 5
+        outputs.append(syncs[2].getresponse().read().decode())
+        print(outputs)
+        for s in outputs:
+            assert '"phase": "finished"' in s
+        assert 'Waiting for another git operation' in outputs[2]
+        for target in ['first', 'second']:
+            assert os.path.isdir(os.path.join(jupyterdir, target, '.git'))
+
+
+@pytest.mark.jupyter_server(extra_env={'PATH': SLOW_GIT_DIR + os.pathsep + os.environ['PATH']})
+def test_identical_syncs_share_pull(slow_git, jupyterdir, jupyter_server):
+    """
+    Tests that identical requests made while a sync is running follow that
+    sync, rather than starting their own.
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+        query = urlencode({'token': 'secret', 'repo': remote.path, 'branch': 'master'})
+
+        start = time.monotonic()
+        syncs = []
+        for i in range(3):
+            h = HTTPConnection('localhost', PORT, 20)
+            h.request('GET', f'/git-pull/api?{query}')
+            syncs.append(h)
+            # Later requests join while the sync lists the remote's refs
+            time.sleep(1)
+
+        outputs = [h.getresponse().read().decode() for h in syncs]
+        print(outputs)
+        assert '"phase": "finished"' in outputs[0]
+        assert outputs[0].count('$ git clone') == 1
+        # Everything the sync produced was replayed to the requests that
+        # joined, though it may have been sent in different batches
+        events = [parse_events(output) for output in outputs]
+        for e in events[1:]:
+            assert ''.join(ev.get('output', '') for ev in e) == ''.join(ev.get('output', '') for ev in events[0])
+            assert e[-1] == events[0][-1]
+        assert time.monotonic() - start < 6
+
+
+@pytest.mark.jupyter_server(extra_env={'NBGITPULLER_LAZY_BLOB_LIMIT': '1k'})
+def test_lazy_download(jupyterdir, jupyter_server):
+    """
+    Tests that large files are only downloaded when opened through the
+    contents API
+    """
+    big = 'x' * 5000
+    with Remote() as remote, Pusher(remote) as pusher:
+        remote.git('config', 'uploadpack.allowFilter', 'true')
+        pusher.write_file('big.txt', big)
+        pusher.git('add', 'big.txt')
+        pusher.push_file('README.md', 'Testing some content')
+        params = {
+            'repo': 'file://' + remote.path,
+            'branch': 'master',
+            'targetpath': 'lazy',
+        }
+        s = request_api(params).read().decode()
+        print(s)
+        assert '"phase": "finished"' in s
+        with open(os.path.join(jupyterdir, 'lazy', 'big.txt')) as f:
+            assert f.read() != big
+
+        h = HTTPConnection('localhost', PORT, 10)
+        h.request('GET', '/api/contents/lazy/big.txt?token=secret&type=file&format=text')
+        r = h.getresponse()
+        assert r.code == 200
+        assert json.loads(r.read())['content'] == big
+        with open(os.path.join(jupyterdir, 'lazy', 'big.txt')) as f:
+            assert f.read() == big
+
+
+@pytest.mark.parametrize('url_path, parent_reldir, targetpath, subpath', [
+    ('lab/tree/repo/week1/nb.ipynb?autodecode', '', 'repo', 'week1/nb.ipynb'),
+    ('/tree/parent/repo/week1', 'parent', 'repo', 'week1'),
+    ('notebooks/repo/nb.ipynb', '', 'repo', 'nb.ipynb'),
+    ('lab/tree/repo/Week%201/nb.ipynb', '', 'repo', 'Week 1/nb.ipynb'),
+    ('lab/tree/my%20repo/nb.ipynb', '', 'my repo', 'nb.ipynb'),
+    ('lab/tree/my%20repo/nb.ipynb', '', 'my%20repo', 'nb.ipynb'),
+    ('tree/repo', '', 'repo', None),
+    ('tree/other-repo/nb.ipynb', '', 'repo', None),
+    ('rstudio', '', 'repo', None),
+])
+def test_link_subpath(url_path, parent_reldir, targetpath, subpath):
+    assert link_subpath(url_path, parent_reldir, targetpath) == subpath
+
+
+def test_sync_stream_headers(jupyterdir, jupyter_server):
+    """
+    Tests that the event stream isn't buffered by proxies, and is compressed
+    for clients that accept it
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', 'Testing some content')
+        query = urlencode({'token': 'secret', 'repo': remote.path, 'branch': 'master'})
+        h = HTTPConnection('localhost', PORT, 10)
+        h.request('GET', f'/git-pull/api?{query}', headers={'Accept-Encoding': 'gzip'})
+        r = h.getresponse()
+        assert r.getheader('X-Accel-Buffering') == 'no'
+        assert r.getheader('Content-Encoding') == 'gzip'
+        s = gzip.decompress(r.read()).decode()
+        assert parse_events(s)[-1]['phase'] == 'finished'
+
+
+def test_coalesce():
+    events = [
+        {'phase': 'syncing', 'output': 'one\n'},
+        {'phase': 'syncing', 'output': 'two 1%\r', 'progress': {'percent': 1}},
+        {'phase': 'syncing', 'output': 'two 2%\r', 'progress': {'percent': 2}},
+        {'phase': 'finished', 'pull_type': 'clone'},
+    ]
+    assert coalesce(events) == [
+        {'phase': 'syncing', 'output': 'one\ntwo 1%\rtwo 2%\r', 'progress': {'percent': 2}},
+        {'phase': 'finished', 'pull_type': 'clone'},
+    ]
+    assert coalesce(events[:1]) == events[:1]
+
+
+def test_sync_operation_batches():
+    """
+    Tests that output published close together is followed as one event
+    """
+    async def run():
+        operation = SyncOperation(logging.getLogger(), max_size=1024)
+        batches = []
+
+        async def follow():
+            async for events in operation.follow(interval=0.2):
+                batches.append(events)
+
+        follower = asyncio.ensure_future(follow())
+        for i in range(10):
+            operation.publish({'phase': 'syncing', 'output': '{}\n'.format(i)})
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.3)
+        operation.publish({'phase': 'finished'})
+        await follower
+        return batches
+
+    batches = asyncio.run(run())
+    assert batches == [
+        [{'phase': 'syncing', 'output': ''.join('{}\n'.format(i) for i in range(10))}],
+        [{'phase': 'finished'}],
+    ]
+
+
+def test_sync_operation_bounded():
+    """
+    Tests that only the most recent output is kept for followers that attach
+    late
+    """
+    async def run():
+        operation = SyncOperation(logging.getLogger(), max_size=100)
+        for i in range(100):
+            operation.publish({'phase': 'syncing', 'output': 'line {:02}\n'.format(i)})
+        operation.publish({'phase': 'finished'})
+        return [events async for events in operation.follow()]
+
+    batches = asyncio.run(run())
+    assert batches == [[
+        {'phase': 'syncing', 'output': '[88 lines of output left out]\n' + ''.join(
+            'line {:02}\n'.format(i) for i in range(88, 100)
+        )},
+        {'phase': 'finished'},
+    ]]
@@ -0,0 +1,67 @@
+import os
+import logging
+
+import pytest
+
+from repohelpers import Remote, Pusher, Puller
+from nbgitpuller import backends
+from nbgitpuller.backends import DulwichBackend, GitCLIBackend, get_backend
+
+
+@pytest.fixture(params=[
+    GitCLIBackend,
+    pytest.param(DulwichBackend, marks=pytest.mark.skipif(backends.Repo is None, reason="dulwich is not installed")),
+])
+def backend(request):
+    return request.param()
+
+
+def test_get_backend(caplog):
+    assert type(get_backend('cli')) is GitCLIBackend
+    with caplog.at_level(logging.WARNING):
+        backend = get_backend('dulwich')
+    if backends.Repo is None:
+        assert type(backend) is GitCLIBackend
+        assert 'dulwich is not installed' in caplog.text
+    else:
+        assert type(backend) is DulwichBackend
+
+
+def test_backend_queries(backend):
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        pusher.push_file('deleted.txt', '1')
+        pusher.push_file('unicode🙂.txt', '1')
+
+        with Puller(remote) as puller:
+            path = puller.path
+            first = puller.git('rev-parse', 'HEAD')
+            assert backend.is_ancestor(path, first, 'HEAD')
+            assert backend.is_ancestor(path, 'HEAD', 'origin/master')
+            assert not backend.is_ancestor(path, '0' * 40, 'HEAD')
+            assert not backend.has_unstaged_changes(path)
+            assert not backend.has_staged_changes(path)
+            assert backend.deleted_files(path) == []
+            assert backend.get_config(path, 'remote.origin.url') == 'file://{}'.format(os.path.abspath(remote.path))
+            assert backend.get_config(path, 'remote.origin.partialclonefilter') is None
+
+            pusher.git('rm', 'deleted.txt')
+            pusher.git('commit', '-m', 'Deleted file')
+            pusher.push_file('README.md', '2')
+            pusher.push_file('new.txt', '1')
+            puller.git('fetch')
+            assert not backend.is_ancestor(path, 'origin/master', 'HEAD')
+            changes = backend.diff(path, 'HEAD', 'origin/master')
+            assert changes.changes == {'A': {'new.txt'}, 'D': {'deleted.txt'}, 'M': {'README.md'}}
+
+            os.remove(os.path.join(path, 'unicode🙂.txt'))
+            assert backend.deleted_files(path) == ['unicode🙂.txt']
+            assert backend.has_unstaged_changes(path)
+            puller.git('checkout', '--', 'unicode🙂.txt')
+
+            puller.write_file('README.md', 'local')
+            assert backend.has_unstaged_changes(path)
+            assert not backend.has_staged_changes(path)
+            puller.git('add', 'README.md')
+            assert not backend.has_unstaged_changes(path)
+            assert backend.has_staged_changes(path)
@@ -0,0 +1,106 @@
+import json
+import os
+import subprocess as sp
+import sys
+
+import pytest
+
+from repohelpers import Remote, Pusher
+from nbgitpuller.bulk import read_manifest, read_synced, summarize, sync_targets
+
+
+def remote_url(remote):
+    return "file://%s" % os.path.abspath(remote.path)
+
+
+def test_read_manifest(tmpdir):
+    csv_path = tmpdir.join('manifest.csv')
+    csv_path.write(
+        'url,branch,target,depth\n'
+        'https://example.com/course.git,main,alice/course,1\n'
+        'https://example.com/course.git,,bob/course,\n'
+    )
+    targets = read_manifest(str(csv_path), root='/home')
+    assert targets == [
+        {'url': 'https://example.com/course.git', 'branch': 'main', 'target': '/home/alice/course', 'depth': 1},
+        {'url': 'https://example.com/course.git', 'branch': None, 'target': '/home/bob/course', 'depth': None},
+    ]
+
+    json_path = tmpdir.join('manifest.json')
+    json_path.write(json.dumps([
+        {'url': 'https://example.com/course.git', 'branch': 'main', 'target': 'alice/course', 'depth': 1},
+        {'url': 'https://example.com/course.git', 'target': 'bob/course'},
+    ]))
+    assert read_manifest(str(json_path), root='/home') == targets
+
+    # A depth of 0 asks for a full clone in both formats
+    csv_path.write('url,target,depth\nhttps://example.com/course.git,alice,0\n')
+    json_path.write(json.dumps([{'url': 'https://example.com/course.git', 'target': 'alice', 'depth': 0}]))
+    assert read_manifest(str(csv_path))[0]['depth'] == 0
+    assert read_manifest(str(json_path))[0]['depth'] == 0
+
+
+@pytest.mark.parametrize('manifest, message', [
+    ('url,target\nhttps://example.com/course.git,\n', 'needs a url and a target'),
+    ('url,target\nhttps://example.com/a.git,course\nhttps://example.com/b.git,course\n', 'syncs into'),
+])
+def test_read_manifest_errors(tmpdir, manifest, message):
+    path = tmpdir.join('manifest.csv')
+    path.write(manifest)
+    with pytest.raises(ValueError, match=message):
+        read_manifest(str(path))
+
+
+def test_sync_targets(tmpdir):
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        targets = [
+            {'url': remote_url(remote), 'branch': None, 'target': str(tmpdir.join(name)), 'depth': None}
+            for name in ['alice', 'bob']
+        ]
+        targets.append({
+            'url': remote_url(remote), 'branch': 'missing', 'target': str(tmpdir.join('carol')), 'depth': None
+        })
+
+        results = sync_targets(targets, workers=2)
+        assert [(r['status'], r.get('pull_type')) for r in results] == [
+            ('ok', 'clone'), ('ok', 'clone'), ('failed', None)
+        ]
+        assert results[2]['error']['code'] == 'branch_exist'
+        for name in ['alice', 'bob']:
+            with open(str(tmpdir.join(name, 'README.md'))) as f:
+                assert f.read() == '1'
+
+        # Syncs that are already up to date are cheap, and the ones that
+        # succeeded before can be skipped altogether
+        summary = summarize(results, 1, 2)
+        assert summary['counts'] == {'ok': 2, 'failed': 1}
+        assert summary['pull_types'] == {'clone': 2}
+        summary_path = tmpdir.join('summary.json')
+        summary_path.write(json.dumps(summary))
+        pusher.push_file('README.md', '2')
+        results = sync_targets(targets, workers=2, synced=read_synced(str(summary_path)))
+        assert [r['status'] for r in results] == ['skipped', 'skipped', 'failed']
+
+        results = sync_targets(targets[:2], workers=2)
+        assert [r['pull_type'] for r in results] == ['fast-forward', 'fast-forward']
+        results = sync_targets(targets[:2], workers=2)
+        assert [r['pull_type'] for r in results] == ['up-to-date', 'up-to-date']
+
+
+def test_main(tmpdir):
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        manifest = tmpdir.join('manifest.csv')
+        manifest.write('url,target\n{},course\n'.format(remote_url(remote)))
+
+        proc = sp.run(
+            [sys.executable, '-m', 'nbgitpuller.bulk', str(manifest), '--root', str(tmpdir),
+             '--workers', '1', '--output', str(tmpdir.join('summary.json'))],
+            stdout=sp.PIPE, check=True,
+        )
+        summary = json.loads(proc.stdout)
+        assert summary['counts'] == {'ok': 1}
+        assert summary['targets'][0]['target'] == str(tmpdir.join('course'))
+        with open(str(tmpdir.join('summary.json'))) as f:
+            assert json.load(f) == summary
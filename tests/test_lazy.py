@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import random
+import subprocess as sp
+import types
+
+import pytest
+
+from repohelpers import Remote, Pusher, Puller
+from nbgitpuller import lazy
+from nbgitpuller.lazy import install_contents_hook, is_placeholder, materialize
+
+
+def random_text(size):
+    return ''.join(random.choice('abcdefghij\n') for _ in range(size))
+
+
+def test_lazy_clone():
+    """
+    Test that large files are replaced by placeholders git ignores, and are
+    downloaded when materialized
+    """
+    big = random_text(5000)
+    with Remote() as remote, Pusher(remote) as pusher:
+        remote.git('config', 'uploadpack.allowFilter', 'true')
+        os.makedirs(os.path.join(pusher.path, 'data'))
+        pusher.write_file('data/big.csv', big)
+        pusher.git('add', 'data/big.csv')
+        pusher.push_file('README.md', '1')
+
+        with Puller(remote, lazy_blob_limit='1k') as puller:
+            path = os.path.join(puller.path, 'data', 'big.csv')
+            assert puller.read_file('README.md') == '1'
+            assert is_placeholder(path)
+            assert puller.git('status', '--porcelain') == ''
+
+            # Pulls leave placeholders alone
+            puller.write_file('README.md', 'local')
+            pusher.push_file('README.md', '2')
+            puller.pull_all()
+            assert puller.read_file('README.md') == 'local'
+            assert is_placeholder(path)
+
+            assert materialize(path)
+            assert puller.read_file('data/big.csv') == big
+            assert puller.git('status', '--porcelain') == ''
+
+            # Once downloaded, local changes are kept like any other file's
+            puller.write_file('data/big.csv', 'local')
+            puller.pull_all()
+            assert puller.read_file('data/big.csv') == 'local'
+
+
+def test_lazy_clone_upstream_change():
+    """
+    Test that placeholders of files changed upstream are replaced by the
+    new version when pulling
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        remote.git('config', 'uploadpack.allowFilter', 'true')
+        pusher.write_file('big.csv', random_text(5000))
+        pusher.git('add', 'big.csv')
+        pusher.push_file('README.md', '1')
+
+        with Puller(remote, lazy_blob_limit='1k') as puller:
+            assert is_placeholder(os.path.join(puller.path, 'big.csv'))
+
+            big = random_text(5000)
+            pusher.push_file('big.csv', big)
+            puller.pull_all()
+            assert puller.read_file('big.csv') == big
+            # git no longer ignores it
+            assert puller.git('ls-files', '-v', 'big.csv') == 'H big.csv'
+
+
+def test_lazy_clone_without_filter_support():
+    """
+    Test that everything is downloaded when the remote doesn't support
+    partial clones
+    """
+    big = random_text(5000)
+    with Remote() as remote, Pusher(remote) as pusher:
+        remote.git('config', 'uploadpack.allowFilter', 'false')
+        pusher.write_file('big.csv', big)
+        pusher.git('add', 'big.csv')
+        pusher.push_file('README.md', '1')
+
+        with Puller(remote, lazy_blob_limit='1k') as puller:
+            assert puller.read_file('big.csv') == big
+
+
+class FakeContentsManager:
+    def __init__(self, root):
+        self.root = root
+
+    def _get_os_path(self, path):
+        return os.path.join(self.root, path)
+
+    def get(self, path, content=True, type=None, format=None):
+        with open(self._get_os_path(path)) as f:
+            return f.read()
+
+
+class FakeAsyncContentsManager(FakeContentsManager):
+    async def get(self, path, content=True, type=None, format=None):
+        return super().get(path, content, type, format)
+
+
+class FakeApp:
+    def __init__(self, contents_manager):
+        self.contents_manager = contents_manager
+        self.log = logging.getLogger('FakeApp')
+        self.web_app = types.SimpleNamespace(settings={})
+
+
+def test_contents_hook():
+    """
+    Test that placeholders are downloaded when read through the contents
+    manager
+    """
+    big = random_text(5000)
+    with Remote() as remote, Pusher(remote) as pusher:
+        remote.git('config', 'uploadpack.allowFilter', 'true')
+        pusher.write_file('big.csv', big)
+        pusher.git('add', 'big.csv')
+        pusher.push_file('README.md', '1')
+
+        with Puller(remote, lazy_blob_limit='1k') as puller:
+            app = FakeApp(FakeAsyncContentsManager(os.path.dirname(puller.path)))
+            install_contents_hook(app)
+            path = os.path.join(os.path.basename(puller.path), 'big.csv')
+
+            asyncio.run(app.contents_manager.get(path, content=False))
+            assert is_placeholder(os.path.join(puller.path, 'big.csv'))
+            assert asyncio.run(app.contents_manager.get(path)) == big
+            assert sp.check_output(['git', 'status', '--porcelain'], cwd=puller.path) == b''
+
+
+def test_contents_hook_sync_manager(caplog):
+    """
+    Test that synchronous contents managers don't download placeholders,
+    which would block the server
+    """
+    with Remote() as remote, Pusher(remote) as pusher:
+        remote.git('config', 'uploadpack.allowFilter', 'true')
+        pusher.write_file('big.csv', random_text(5000))
+        pusher.git('add', 'big.csv')
+        pusher.push_file('README.md', '1')
+
+        with Puller(remote, lazy_blob_limit='1k') as puller:
+            app = FakeApp(FakeContentsManager(os.path.dirname(puller.path)))
+            install_contents_hook(app)
+            path = os.path.join(os.path.basename(puller.path), 'big.csv')
+
+            with caplog.at_level(logging.WARNING):
+                assert is_placeholder(os.path.join(puller.path, 'big.csv'))
+                app.contents_manager.get(path)
+            assert is_placeholder(os.path.join(puller.path, 'big.csv'))
+            assert 'needs an asynchronous contents manager' in caplog.text
+
+
+@pytest.mark.parametrize('contents_manager', [FakeContentsManager, FakeAsyncContentsManager])
+def test_contents_hook_no_git_for_regular_files(tmpdir, monkeypatch, contents_manager):
+    """
+    Test that reading files that aren't placeholders runs no git, and doesn't
+    look for the repository they are in
+    """
+    tmpdir.join('repo', '.git').ensure(dir=True)
+    tmpdir.join('repo', 'README.md').write('hello')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('git was run')
+
+    monkeypatch.setattr(lazy.subprocess, 'check_output', fail)
+    monkeypatch.setattr(lazy.subprocess, 'check_call', fail)
+    monkeypatch.setattr(lazy, 'find_repo_dir', fail)
+    app = FakeApp(contents_manager(str(tmpdir)))
+    install_contents_hook(app)
+    content = app.contents_manager.get('repo/README.md')
+    if contents_manager is FakeAsyncContentsManager:
+        content = asyncio.run(content)
+    assert content == 'hello'
+    assert not materialize(str(tmpdir.join('repo', 'README.md')))
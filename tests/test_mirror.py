@@ -0,0 +1,99 @@
+import os
+import subprocess as sp
+import sys
+
+from repohelpers import Remote, Pusher, Puller
+from nbgitpuller.cache import mirror_path
+from nbgitpuller.errors import GitPullerError
+from nbgitpuller.mirror import read_repos_file, update_mirror
+
+
+def remote_url(remote):
+    return "file://%s" % os.path.abspath(remote.path)
+
+
+def test_pull_from_mirror(tmpdir):
+    """
+    Test that clones and pulls fetch from the mirror, while origin still
+    points to the remote
+    """
+    mirror_dir = str(tmpdir.join('mirrors'))
+    os.makedirs(mirror_dir)
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        update_mirror(mirror_dir, remote_url(remote))
+
+        with Puller(remote, mirror_dir=mirror_dir) as puller:
+            assert puller.read_file('README.md') == '1'
+            assert puller.git('remote', 'get-url', 'origin') == remote_url(remote)
+
+            # Changes only show up once they're mirrored
+            pusher.push_file('README.md', '2')
+            puller.pull_all()
+            assert puller.read_file('README.md') == '1'
+
+            update_mirror(mirror_dir, remote_url(remote))
+            puller.pull_all()
+            assert puller.read_file('README.md') == '2'
+
+
+def test_mirror_prunes(tmpdir):
+    """
+    Test that branches deleted from the remote are deleted from the mirror
+    """
+    mirror_dir = str(tmpdir.join('mirrors'))
+    os.makedirs(mirror_dir)
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        pusher.git('push', 'origin', 'master:other')
+        path = update_mirror(mirror_dir, remote_url(remote))
+        assert path == mirror_path(mirror_dir, remote_url(remote))
+        assert 'refs/heads/other' in sp.check_output(['git', 'for-each-ref'], cwd=path).decode()
+
+        pusher.git('push', 'origin', ':other')
+        update_mirror(mirror_dir, remote_url(remote))
+        assert 'refs/heads/other' not in sp.check_output(['git', 'for-each-ref'], cwd=path).decode()
+
+
+def test_remote_without_mirror(tmpdir):
+    """
+    Test that remotes without a mirror are used directly
+    """
+    mirror_dir = str(tmpdir.join('mirrors'))
+    os.makedirs(mirror_dir)
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        with Puller(remote, mirror_dir=mirror_dir) as puller:
+            assert puller.read_file('README.md') == '1'
+
+
+def test_mirror_error_code():
+    """
+    Test that failures of git commands using a mirror are still categorised
+    """
+    exc = sp.CalledProcessError(128, ['git', '-c', 'url.file:///m.insteadOf=file:///r', 'fetch'])
+    assert GitPullerError.from_exception(exc).code == 'ls_remote'
+
+
+def test_main(tmpdir):
+    """
+    Test the gitpuller-mirror command line
+    """
+    mirror_dir = str(tmpdir.join('mirrors'))
+    repos_file = tmpdir.join('repos.txt')
+    with Remote() as remote, Pusher(remote) as pusher:
+        pusher.push_file('README.md', '1')
+        repos_file.write('# Mirrored for class\n\n{}\n'.format(remote_url(remote)))
+        assert read_repos_file(str(repos_file)) == [remote_url(remote)]
+
+        sp.check_call([
+            sys.executable, '-m', 'nbgitpuller.mirror', mirror_dir,
+            '--repos-file', str(repos_file), '--once'
+        ])
+        assert os.path.isdir(mirror_path(mirror_dir, remote_url(remote)))
+
+        # Failures are reported through the exit code
+        assert sp.call([
+            sys.executable, '-m', 'nbgitpuller.mirror', mirror_dir,
+            'file:///does/not/exist', '--once'
+        ]) == 1
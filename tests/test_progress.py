@@ -0,0 +1,76 @@
+import os
+
+from repohelpers import Remote, Pusher
+from nbgitpuller.progress import ProgressCollapser, parse_progress
+from nbgitpuller.pull import GitPuller
+
+
+def test_parse_progress():
+    assert parse_progress('Receiving objects:  45% (450/1000), 3.00 MiB | 2.00 MiB/s\r') == {
+        'stage': 'Receiving objects',
+        'percent': 45,
+        'current': 450,
+        'total': 1000,
+        'transferred': '3.00 MiB',
+        'rate': '2.00 MiB/s',
+        'done': False,
+    }
+    assert parse_progress('remote: Counting objects: 100% (3/3), done.        \n') == {
+        'stage': 'Counting objects',
+        'percent': 100,
+        'current': 3,
+        'total': 3,
+        'transferred': None,
+        'rate': None,
+        'done': True,
+    }
+    assert parse_progress('remote: Enumerating objects: 302, done.\n')['current'] == 302
+    assert parse_progress('Receiving objects: 100% (302/302), 616.96 KiB | 8.01 MiB/s, done.\n')['done']
+    assert parse_progress("Cloning into 'repo'...\n") is None
+    assert parse_progress('remote: Total 302 (delta 0), reused 0 (delta 0), pack-reused 0\n') is None
+    assert parse_progress('Merge made by the \'ort\' strategy.\n') is None
+
+
+def test_collapse_progress(monkeypatch):
+    now = [0]
+    monkeypatch.setattr('nbgitpuller.progress.time.monotonic', lambda: now[0])
+    collapser = ProgressCollapser(interval=1)
+
+    def events(lines):
+        return [event for event in map(collapser.event, lines) if event is not None]
+
+    output = events(["Cloning into 'repo'...\n"])
+    assert output == [{'phase': 'syncing', 'output': "Cloning into 'repo'...\n"}]
+
+    # The first line of a stage is passed on, and then only changed
+    # percentages at most once per interval
+    lines = ['Receiving objects:  {}% ({}/100)\r'.format(n, n) for n in range(50)]
+    assert [event['progress']['percent'] for event in events(lines)] == [0]
+    now[0] = 1
+    assert [event['progress']['percent'] for event in events(lines[49:] + lines[49:])] == [49]
+    now[0] = 2
+    assert events(lines[49:]) == []
+
+    # The line a stage is done on, and the start of the next one, always are
+    output = events([
+        'Receiving objects: 100% (100/100), 1.00 KiB | 1.00 MiB/s, done.\n',
+        'Resolving deltas:   0% (0/10)\r',
+        'Resolving deltas:  10% (1/10)\r',
+    ])
+    assert [(event['progress']['stage'], event['progress']['percent']) for event in output] == [
+        ('Receiving objects', 100),
+        ('Resolving deltas', 0),
+    ]
+    assert output[0]['progress']['rate'] == '1.00 MiB/s'
+
+
+def test_clone_progress(tmpdir):
+    with Remote() as remote, Pusher(remote) as pusher:
+        for i in range(20):
+            pusher.push_file('file{}.txt'.format(i), str(i))
+
+        gp = GitPuller('file://' + os.path.abspath(remote.path), str(tmpdir.join('clone')))
+        collapser = ProgressCollapser()
+        events = [event for event in map(collapser.event, gp.pull()) if event is not None]
+        progress = [event['progress'] for event in events if 'progress' in event]
+        assert any(p['stage'] == 'Receiving objects' and p['done'] for p in progress)